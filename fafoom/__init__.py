@@ -1,4 +1,10 @@
 from structure import MoleculeDescription, Structure
+from blacklist import Blacklist
+from island import Island
+from surrogate import Surrogate
+from sampler import WeightedSampler
+from population import Population
+from ga_engine import GeneticAlgorithm
 from genetic_operations import selection, crossover
 from pyaims import AimsObject
 from pyff import FFObject
@@ -0,0 +1,409 @@
+#    Copyright 2015 Adriana Supady
+#
+#    This file is part of fafoom.
+#
+#   Fafoom is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Fafoom is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
+''' Container for the already evaluated structures '''
+from __future__ import division
+import math
+import multiprocessing
+import numpy as np
+
+from utilities import (
+    kabsch_rms_batch,
+    lowest_tor_rmsd,
+    KABSCH_CHUNK,
+    PROFILE_BOUND_TOLERANCE
+)
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+class Blacklist(object):
+    """List of structures that have already been evaluated.
+
+    The container behaves like a list (append, len, iteration, indexing) and
+    'structure in blacklist' has the same meaning as for a list, i.e. it is
+    True if the structure is equal (Structure.__eq__) to any stored one.
+
+    To avoid comparing a new structure with all stored ones, each stored
+    structure is mapped to points such that equal structures lie within a
+    known radius; only the structures within this radius are compared
+    exactly:
+
+    * rmsd_type='internal_coord': the values of one periodic degree of
+      freedom (torsion or cistrans, the one with most positions) are
+      embedded as points (cos, sin) on the torus. Two structures can only be
+      equal if the torsional RMSD of this degree of freedom is below
+      rmsd_cutoff_uniq; the Euclidean distance of the points is then below
+      pi*rmsd_cutoff_uniq*sqrt(n) (n: number of positions). Mirror images
+      are handled by also querying the inverted values if the molecule is
+      not chiral. The values of all torsion and cistrans degrees of freedom
+      are kept as arrays, so that a new structure is compared with all
+      candidates at once (see utilities.lowest_tor_rmsd).
+    * rmsd_type='cartesian': the sorted atom-centroid distances (see
+      utilities.distance_profile) give a lower bound of the Cartesian RMS
+      that is invariant under superposition, symmetry and reflection; the
+      points are the profiles and the radius is
+      rmsd_cutoff_uniq*sqrt(atoms) (atoms: number of compared atoms). The
+      stored geometries are kept stacked in one array, so that a new
+      structure is aligned to all remaining ones in a single vectorized
+      operation.
+
+    The initial geometries (values) of the stored structures are indexed
+    too. New points are collected in a buffer and the KD-tree (scipy) is
+    rebuilt once the buffer grows beyond a fraction of the indexed points.
+    If no suitable degree of freedom is found, the structures are compared
+    one by one.
+
+    With processes > 1 the Cartesian alignments are distributed in blocks to
+    a pool of worker processes that hold a copy of the indexed geometries;
+    the pool is started with the first lookup and restarted once the
+    geometries added since then exceed a fraction of the copied ones.
+    """
+    min_pending = 32
+
+    def __init__(self, structures=None, processes=1):
+        if processes < 1:
+            raise ValueError("The number of processes must be positive.")
+        self._processes = processes
+        self._pool = None
+        self._shared = 0
+        self._structures = []
+        self._mode = None
+        self._dof_index = None
+        self._variants = []
+        self._points = None
+        self._geometries = None
+        self._owners = []
+        self._tree = None
+        self._pending_points = []
+        self._pending_geometries = []
+        self._pending_owners = []
+        if structures is not None:
+            for structure in structures:
+                self.append(structure)
+
+    def __len__(self):
+        return len(self._structures)
+
+    def __iter__(self):
+        return iter(self._structures)
+
+    def __getitem__(self, ind):
+        return self._structures[ind]
+
+    def __contains__(self, structure):
+        self._setup(structure)
+        if self._mode == "cartesian" and \
+           not hasattr(structure, "initial_coords"):
+            return self._contains_cartesian(structure)
+        if self._mode == "internal_coord" and \
+           not hasattr(structure, "initial_sdf_string"):
+            return self._contains_internal(structure)
+        if self._mode == "scan":
+            candidates = range(len(self._structures))
+        else:
+            candidates = self._candidates(structure)
+        for ind in candidates:
+            stored = self._structures[ind]
+            if stored is structure or structure == stored:
+                return True
+        return False
+
+    def close(self):
+        """Stop the worker processes (if any)."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool, self._shared = None, 0
+
+    def append(self, structure):
+        """Add the structure to the blacklist."""
+        self._setup(structure)
+        self._structures.append(structure)
+        if self._mode == "scan":
+            return
+        owner = len(self._structures)-1
+        for point in self._points_for(structure, query=False):
+            self._pending_points.append(point)
+            self._pending_owners.append(owner)
+        if self._mode == "cartesian":
+            self._pending_geometries.extend(self._geometries_for(structure))
+        else:
+            self._variants.append(self._variants_for(structure))
+        if len(self._pending_points) > max(Blacklist.min_pending,
+                                           len(self._owners)//4):
+            self._rebuild()
+
+    def _setup(self, structure):
+        """Select the kind of index."""
+        if self._mode is not None:
+            return
+        self._mode = "scan"
+        if structure.mol_info.rmsd_type == 'cartesian':
+            self._mode = "cartesian"
+        elif structure.mol_info.rmsd_type == 'internal_coord':
+            most = 0
+            for ind, dof in enumerate(structure.dof):
+                if dof.type in ["torsion", "cistrans"] and \
+                   len(dof.positions) > most:
+                    self._dof_index, most = ind, len(dof.positions)
+            if self._dof_index is not None:
+                self._mode = "internal_coord"
+
+    def _points_for(self, structure, query):
+        """Return the points of a stored structure (query=False) or the
+        points to look up for a new structure (query=True)."""
+        if self._mode == "cartesian":
+            points = [structure.get_distance_profile()]
+            if hasattr(structure, "initial_coords"):
+                points.append(structure.get_distance_profile(initial=True))
+            return points
+        dof = structure.dof[self._dof_index]
+        variants = [dof.values]
+        if hasattr(dof, "initial_values"):
+            variants.append(dof.initial_values)
+        if query and not structure.mol_info.chiral:
+            variants += [[-1*i for i in values] for values in variants]
+        return [self._embed(values) for values in variants]
+
+    @staticmethod
+    def _geometries_for(structure):
+        """Return the geometries of a stored structure (in the order of the
+        points) restricted to the atoms compared in the Cartesian RMSD."""
+        atoms = structure.mol_info.get_symmetry_maps().shape[1]
+        geometries = [structure.coords[:atoms]]
+        if hasattr(structure, "initial_coords"):
+            geometries.append(structure.initial_coords[:atoms])
+        return geometries
+
+    @staticmethod
+    def _variants_for(structure):
+        """Return the values and initial values of the torsion and cistrans
+        degrees of freedom of a stored structure, each of shape (2, n)."""
+        variants = {}
+        for ind, dof in enumerate(structure.dof):
+            if dof.type in ["torsion", "cistrans"]:
+                values = dof.get_variants()
+                if len(values) == 1:
+                    values = np.repeat(values, 2, axis=0)
+                variants[ind] = values
+        return variants
+
+    def _radius(self, structure):
+        """Return the radius within which equal structures are found."""
+        cutoff = structure.mol_info.rmsd_cutoff_uniq
+        if self._mode == "cartesian":
+            return (cutoff+PROFILE_BOUND_TOLERANCE) * \
+                math.sqrt(len(structure.mol_info.get_symmetry_classes()))
+        dof = structure.dof[self._dof_index]
+        return math.pi*cutoff*math.sqrt(len(dof.positions))+1e-9
+
+    @staticmethod
+    def _embed(values):
+        """Map the angles [in deg] to points (cos, sin) on the torus."""
+        rad = np.radians(np.asarray(values, dtype=float))
+        return np.concatenate((np.cos(rad), np.sin(rad)))
+
+    def _rebuild(self):
+        """Move the buffered points (and geometries) to the index."""
+        new_points = np.array(self._pending_points)
+        if self._points is None:
+            self._points = new_points
+        else:
+            self._points = np.vstack((self._points, new_points))
+        if self._mode == "cartesian":
+            new_geometries = np.array(self._pending_geometries)
+            if self._geometries is None:
+                self._geometries = new_geometries
+            else:
+                self._geometries = np.concatenate((self._geometries,
+                                                   new_geometries))
+        self._owners.extend(self._pending_owners)
+        self._pending_points, self._pending_owners = [], []
+        self._pending_geometries = []
+        if cKDTree is not None:
+            self._tree = cKDTree(self._points)
+
+    def _hits(self, structure):
+        """Return the indices of the indexed and of the buffered points that
+        lie within the radius around the points of the structure."""
+        radius = self._radius(structure)
+        indexed, pending = set(), set()
+        for point in self._points_for(structure, query=True):
+            if self._points is not None:
+                if self._tree is not None:
+                    indexed.update(self._tree.query_ball_point(point, radius))
+                else:
+                    indexed.update(_within(self._points, point, radius))
+            if self._pending_points:
+                pending.update(_within(np.array(self._pending_points), point,
+                                       radius))
+        return sorted(indexed), sorted(pending)
+
+    def _candidates(self, structure):
+        """Return the sorted indices of the stored structures that may be
+        equal to the structure."""
+        indexed, pending = self._hits(structure)
+        found = set(self._owners[i] for i in indexed)
+        found.update(self._pending_owners[i] for i in pending)
+        return sorted(found)
+
+    def _contains_internal(self, structure):
+        """Compare a new (not relaxed) structure with the candidates, see
+        Structure.__eq__. The torsion and cistrans degrees of freedom are
+        compared with all candidates at once, the remaining ones one by
+        one."""
+        candidates = np.array(self._candidates(structure), dtype=int)
+        if len(candidates) == 0:
+            return False
+        if any(self._structures[ind] is structure for ind in candidates):
+            return True
+        cutoff = structure.mol_info.rmsd_cutoff_uniq
+        mirror = not structure.mol_info.chiral
+        for ind, dof in enumerate(structure.dof):
+            if ind not in self._variants[0]:
+                continue
+            others = np.array([self._variants[i][ind] for i in candidates])
+            rmsd = lowest_tor_rmsd(dof.values, others, mirror)
+            candidates = candidates[rmsd <= cutoff]
+            if len(candidates) == 0:
+                return False
+        for ind in candidates:
+            stored = self._structures[ind]
+            if all(dof1.is_equal(dof2, cutoff, structure.mol_info.chiral)
+                   for dof1, dof2 in zip(structure.dof, stored.dof)
+                   if dof1.type not in ["torsion", "cistrans"]):
+                return True
+        return False
+
+    def _contains_cartesian(self, structure):
+        """Compare a new (not relaxed) structure with the stored geometries
+        within the radius, see utilities.kabsch_rms_batch. The geometries are
+        aligned in blocks, starting with the closest distance profiles, until
+        an equal one is found. With a pool, the geometries not yet copied to
+        the workers are aligned here first and the remaining blocks are
+        distributed to the workers; the first match ends the search."""
+        indexed, pending = self._hits(structure)
+        points, geometries = [], []
+        if indexed:
+            points.append(self._points[indexed])
+            geometries.append(self._geometries[indexed])
+        if pending:
+            points.append(np.array([self._pending_points[i]
+                                    for i in pending]))
+            geometries.append(np.array([self._pending_geometries[i]
+                                        for i in pending]))
+        if not points:
+            return False
+        points = np.concatenate(points)
+        geometries = np.concatenate(geometries)
+        diff = points-structure.get_distance_profile()
+        order = np.argsort(np.sum(diff*diff, axis=1))
+        maps = structure.mol_info.get_symmetry_maps()
+        coords = structure.coords[:maps.shape[1]]
+        mirror = not structure.mol_info.chiral
+        cutoff = structure.mol_info.rmsd_cutoff_uniq
+        block = max(1, KABSCH_CHUNK//len(maps))
+        for start in range(0, len(order), block):
+            if self._processes > 1 and start > 0:
+                found = self._pool_search(coords, indexed, pending,
+                                          order[start:], geometries, maps,
+                                          mirror, cutoff)
+                if found is not None:
+                    return found
+            rms = kabsch_rms_batch(coords,
+                                   geometries[order[start:start+block]],
+                                   maps, mirror)
+            if np.any(rms <= cutoff):
+                return True
+        return False
+
+    def _pool_search(self, coords, indexed, pending, order, geometries, maps,
+                     mirror, cutoff):
+        """Align the geometries (indices order) with the worker processes.
+
+        Returns True if an equal geometry is found, False if not and None if
+        too few geometries are shared with the workers (the search then
+        continues serially)."""
+        block = max(1, KABSCH_CHUNK//len(maps))
+        self._update_pool(maps, mirror, cutoff)
+        indices = np.concatenate((np.array(indexed, dtype=int),
+                                  -np.ones(len(pending), dtype=int)))[order]
+        shared = (indices >= 0) & (indices < self._shared)
+        if np.count_nonzero(shared) <= block:
+            return None
+        local = order[~shared]
+        for start in range(0, len(local), block):
+            rms = kabsch_rms_batch(coords,
+                                   geometries[local[start:start+block]],
+                                   maps, mirror)
+            if np.any(rms <= cutoff):
+                return True
+        self._query.value += 1
+        indices = indices[shared]
+        tasks = [(self._query.value, coords, indices[start:start+block])
+                 for start in range(0, len(indices), block)]
+        for found in self._pool.imap_unordered(_pool_match, tasks):
+            if found:
+                self._query.value += 1
+                return True
+        return False
+
+    def _update_pool(self, maps, mirror, cutoff):
+        """Start the worker processes with a copy of the indexed geometries
+        or restart them if too many geometries are missing in the copy."""
+        if self._geometries is None:
+            return
+        missing = len(self._geometries)-self._shared
+        if self._pool is not None and \
+           missing <= max(Blacklist.min_pending, self._shared//4):
+            return
+        self.close()
+        self._query = multiprocessing.Value('l', 0, lock=False)
+        self._pool = multiprocessing.Pool(self._processes, _pool_init,
+                                          (self._geometries, maps, mirror,
+                                           cutoff, self._query))
+        self._shared = len(self._geometries)
+
+
+def _within(points, point, radius):
+    """Return the indices of the points within the radius around point."""
+    diff = points-point
+    return np.nonzero(np.sum(diff*diff, axis=1) <= radius**2)[0]
+
+
+_pool_data = {}
+
+
+def _pool_init(geometries, maps, mirror, cutoff, query):
+    """Keep the data of the blacklist in the worker process."""
+    _pool_data.update(geometries=geometries, maps=maps, mirror=mirror,
+                      cutoff=cutoff, query=query)
+
+
+def _pool_match(task):
+    """Return True if the geometry is equal to any of the geometries with the
+    given indices (worker process). The blocks of a search that has already
+    ended are skipped."""
+    query, coords, indices = task
+    if query != _pool_data['query'].value:
+        return False
+    rms = kabsch_rms_batch(coords, _pool_data['geometries'][indices],
+                           _pool_data['maps'], _pool_data['mirror'])
+    return bool(np.any(rms <= _pool_data['cutoff']))
@@ -17,19 +17,29 @@
 ''' Handle the degrees of freedom.'''
 from __future__ import division
 import math
+import numpy as np
 from copy import copy
 from random import choice
 from rdkit import Chem
 
-from utilities import ig, cleaner, get_vec, tor_rmsd, find_one_in_list
+from utilities import (
+    ig,
+    cleaner,
+    get_vec,
+    lowest_tor_rmsd,
+    sdf2coords
+)
 from measure import (
-    dihedral_measure,
-    dihedral_set,
-    pyranosering_measure,
-    pyranosering_set
+    dihedral_measure_coords,
+    dihedral_set_coords,
+    dihedral_set_multiple,
+    pyranosering_classify,
+    pyranosering_set,
+    pyranosering_set_coords
 )
 
 from genetic_operations import mutation
+from sampler import weighted_sampler
 
 
 class DOF:
@@ -112,9 +122,9 @@ class Torsion(DOF):
             generated
         """
         if len(weights) == len(Torsion.values_options):
-            self.values = [Torsion.values_options[find_one_in_list(sum(
-                           weights), weights)]
-                           for i in range(len(self.positions))]
+            self.values = [Torsion.values_options[i] for i in
+                           weighted_sampler(weights).draw(
+                               len(self.positions))]
         else:
             self.values = [choice(Torsion.values_options)
                            for i in range(len(self.positions))]
@@ -130,11 +140,31 @@ class Torsion(DOF):
         """
         if values_to_set is not None:
             self.values = values_to_set
-        for i in range(len(self.positions)):
-            string = dihedral_set(string, self.positions[i],
-                                  self.values[i])
+        string = dihedral_set_multiple(string, self.positions, self.values)
         return string
 
+    def apply_on_coords(self, coords, carried_atoms, values_to_set=None,
+                        check=None):
+        """Adjust the coordinates to match the values of the Torsion object.
+
+        Args(required):
+            coords (numpy array): Cartesian coordinates
+            carried_atoms (list): moving-fragment atom indices for each
+            position
+        Args(optional):
+            values_to_set (list) : a list of values to be set can be passed
+            directly
+            check (function): called as check(coords, i) after the torsion
+            at the i-th position has been set, see
+            measure.dihedral_set_coords
+        Returns:
+            new coordinates (numpy array) or None if the check failed
+        """
+        if values_to_set is not None:
+            self.values = values_to_set
+        return dihedral_set_coords(coords, self.positions, self.values,
+                                   carried_atoms, check)
+
     def mutate_values(self, max_mutations=None, weights=None):
         """Call for a mutation of the list of Torsion object values
 
@@ -154,11 +184,16 @@ class Torsion(DOF):
         Args:
             sdf_string
         """
-        updated_values = []
-        for i in range(len(self.positions)):
-            updated_values.append(dihedral_measure(string,
-                                                   self.positions[i]))
-        self.values = updated_values
+        self.update_values_from_coords(sdf2coords(string))
+
+    def update_values_from_coords(self, coords):
+        """Measure and update the Torsion object values.
+
+        Args:
+            coords (numpy array): Cartesian coordinates
+        """
+        self.values = dihedral_measure_coords(coords,
+                                              self.positions).tolist()
 
     def is_equal(self, other, threshold, chiral=True):
         """Decide if the values of two Torsion objects are equal or not
@@ -170,23 +205,21 @@ class Torsion(DOF):
             structure will be considered too
         """
 
-        values = []
-        values.append(tor_rmsd(2, get_vec(self.values, other.values)))
-
-        if hasattr(other, "initial_values"):
-            values.append(tor_rmsd(2, get_vec(self.values,
-                                              other.initial_values)))
-        if not chiral:
-            values.append(tor_rmsd(2, get_vec(self.values,
-                                              [-1*i for i in other.values])))
-            if hasattr(other, "initial_values"):
-                values.append(tor_rmsd(2, get_vec(self.values, [-1*i for i in
-                                                  other.initial_values])))
-        if min(values) > threshold:
+        rmsd = lowest_tor_rmsd(self.values, [other.get_variants()],
+                               not chiral)[0]
+        if rmsd > threshold:
             return False
         else:
             return True
 
+    def get_variants(self):
+        """Return the values and, if present, the initial values (rows of a
+        numpy array) to be compared with, see utilities.lowest_tor_rmsd."""
+        variants = [self.values]
+        if hasattr(self, "initial_values"):
+            variants.append(self.initial_values)
+        return np.array(variants, dtype=float)
+
 
 class PyranoseRing(DOF):
 
@@ -271,6 +304,10 @@ class PyranoseRing(DOF):
 
     values_options = range(0, len(dict_for_ring_dih), 1)
 
+    # (38, 6) array of the ring dihedrals, the row index is the ring value
+    ring_dih_array = np.array(map(dict_for_ring_dih.get,
+                                  [str(i) for i in values_options]))
+
     @staticmethod
     def find(smiles, pyranosering_pattern="C1(CCCCO1)O", positions=None):
         if positions is None:
@@ -292,9 +329,9 @@ class PyranoseRing(DOF):
 
     def get_weighted_values(self, weights):
         if len(weights) == len(PyranoseRing.values_options):
-            self.values = [PyranoseRing.values_options[find_one_in_list(sum(
-                           weights), weights)]
-                           for i in range(len(self.positions))]
+            self.values = [PyranoseRing.values_options[i] for i in
+                           weighted_sampler(weights).draw(
+                               len(self.positions))]
         else:
             self.values = [choice(PyranoseRing.values_options)
                            for i in range(len(self.positions))]
@@ -311,13 +348,25 @@ class PyranoseRing(DOF):
                                       val_ang)
         return string
 
-    def update_values(self, string):
-        updated_values = []
+    def apply_on_coords(self, coords, carried_atoms, values_to_set=None):
+        if values_to_set is not None:
+            self.values = values_to_set
         for i in range(len(self.positions)):
-            updated_values.append(pyranosering_measure(string,
-                                  self.positions[i],
-                                  PyranoseRing.dict_for_ring_dih))
-        self.values = updated_values
+            val_dih = PyranoseRing.dict_for_ring_dih[str(
+                                                     int(self.values[i]))][:5]
+            val_ang = PyranoseRing.dict_for_ring_ang[str(
+                                                     int(self.values[i]))][:5]
+            coords = pyranosering_set_coords(coords, self.positions[i],
+                                             val_dih, val_ang,
+                                             carried_atoms[i])
+        return coords
+
+    def update_values(self, string):
+        self.update_values_from_coords(sdf2coords(string))
+
+    def update_values_from_coords(self, coords):
+        self.values = pyranosering_classify(
+            coords, self.positions, PyranoseRing.ring_dih_array).tolist()
 
     def mutate_values(self, max_mutations=None, weights=None):
         if max_mutations is None:
@@ -371,16 +420,23 @@ class CisTrans(DOF):
 
         if values_to_set is not None:
             self.values = values_to_set
-
-        for i in range(len(self.positions)):
-            string = dihedral_set(string, self.positions[i], self.values[i])
+        string = dihedral_set_multiple(string, self.positions, self.values)
         return string
 
+    def apply_on_coords(self, coords, carried_atoms, values_to_set=None,
+                        check=None):
+
+        if values_to_set is not None:
+            self.values = values_to_set
+        return dihedral_set_coords(coords, self.positions, self.values,
+                                   carried_atoms, check)
+
     def update_values(self, string):
-        updated_values = []
-        for i in range(len(self.positions)):
-            updated_values.append(dihedral_measure(string, self.positions[i]))
-        self.values = updated_values
+        self.update_values_from_coords(sdf2coords(string))
+
+    def update_values_from_coords(self, coords):
+        self.values = dihedral_measure_coords(coords,
+                                              self.positions).tolist()
 
     def get_random_values(self):
         self.values = [choice(CisTrans.values_options)
@@ -388,9 +444,9 @@ class CisTrans(DOF):
 
     def get_weighted_values(self, weights):
         if len(weights) == len(CisTrans.values_options):
-            self.values = [CisTrans.values_options[find_one_in_list(sum(
-                           weights), weights)]
-                           for i in range(len(self.positions))]
+            self.values = [CisTrans.values_options[i] for i in
+                           weighted_sampler(weights).draw(
+                               len(self.positions))]
         else:
             self.values = [choice(CisTrans.values_options)
                            for i in range(len(self.positions))]
@@ -404,20 +460,17 @@ class CisTrans(DOF):
                                CisTrans.values_options, weights, periodic=True)
 
     def is_equal(self, other, threshold, chiral=True):
-        values = []
-        values.append(tor_rmsd(2, get_vec(self.values, other.values)))
-
-        if hasattr(other, "initial_values"):
-            values.append(tor_rmsd(2, get_vec(self.values,
-                                              other.initial_values)))
-
-        if not chiral:
-            values.append(tor_rmsd(2, get_vec(self.values,
-                                              [-1*i for i in other.values])))
-            if hasattr(other, "initial_values"):
-                values.append(tor_rmsd(2, get_vec(self.values,
-                                       [-1*i for i in other.initial_values])))
-        if min(values) > threshold:
+        rmsd = lowest_tor_rmsd(self.values, [other.get_variants()],
+                               not chiral)[0]
+        if rmsd > threshold:
             return False
         else:
             return True
+
+    def get_variants(self):
+        """Return the values and, if present, the initial values (rows of a
+        numpy array) to be compared with, see utilities.lowest_tor_rmsd."""
+        variants = [self.values]
+        if hasattr(self, "initial_values"):
+            variants.append(self.initial_values)
+        return np.array(variants, dtype=float)
@@ -0,0 +1,786 @@
+#    Copyright 2015 Adriana Supady
+#
+#    This file is part of fafoom.
+#
+#   Fafoom is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Fafoom is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
+''' Genetic algorithm engine '''
+from __future__ import division
+import glob
+import multiprocessing
+import os
+import Queue
+import numpy as np
+
+from structure import MoleculeDescription, Structure
+from blacklist import Blacklist
+from island import Island
+from surrogate import Surrogate
+from population import Population
+from genetic_operations import selection
+from pyff import FFObject
+from utilities import print_output, remover_dir, set_default, file2dict, backup
+from run_utilities import (
+    collect_optimized,
+    detect_energy_function,
+    find_linked_params,
+    is_converged,
+    kill_requested,
+    optimize_all,
+    optimize_async,
+    perform_backup,
+    relax_info,
+    str_info
+)
+
+
+class _Stop(Exception):
+    """Raised to end the run (the message is written to the output)."""
+    pass
+
+
+class GeneticAlgorithm(object):
+    """Genetic algorithm search for the conformations of a molecule.
+
+    The engine reads the 'GA settings' and 'Run settings' of a parameter
+    file (see the manual) and keeps the state of the run (molecule,
+    population, blacklist, lowest energies, iteration). All files (output,
+    storage directories, backup files) are written to the current
+    directory. The run is either started with initialize() or continued
+    from the backup files with restart(); step() performs one iteration
+    and run() iterates until the run is converged, the maximal number of
+    iterations is reached or a kill.dat file is found.
+
+    The selection, the genetic operators and the energy function can be
+    replaced by functions:
+
+    * selection(population) returns two parents,
+    * crossover(parent1, parent2) returns two children,
+    * mutation(structure) mutates the structure in place,
+    * energy_function(structure, name) optimizes the structure in place
+      (it has to be a module-level function if relax_processes > 1).
+
+    With prescreen_candidates > 1, several mutated candidates are created
+    for each child and ranked with a cheap force-field optimization (see
+    _prescreen); only the best one (or the ones within prescreen_window)
+    is relaxed with the energy function. With surrogate_candidates > 1,
+    the candidates are first ranked with a surrogate model (see Surrogate)
+    trained on the blacklist at the start of each iteration; the candidates
+    are created as arrays of values (see Population) and only the best
+    ranked ones are built as structures.
+
+    Functions added with add_callback are called after a structure has been
+    added to the population ('structure': function(engine, structure)) and
+    after each iteration ('iteration': function(engine)).
+    """
+    dict_default = {'energy_var': 0.001, 'selection': "roulette_wheel",
+                    'fitness_sum_limit': 1.2, 'popsize': 10,
+                    'prob_for_crossing': 1.0, 'max_iter': 30,
+                    'iter_limit_conv': 20, 'energy_diff_conv': 0.001,
+                    'blacklist_processes': 1, 'children_per_generation': 2,
+                    'relax_processes': 1, 'steady_state': False,
+                    'island_dir': None, 'island_name': None,
+                    'migration_interval': 5, 'migration_size': 1,
+                    'prescreen_candidates': 1, 'prescreen_window': None,
+                    'prescreen_force_field': "mmff94", 'prescreen_steps': 1000,
+                    'surrogate_candidates': 1, 'surrogate_max_samples': 500,
+                    'surrogate_regularization': 0.001}
+    cnt_max = 200
+    # Interval [s] for checking for a kill.dat file while waiting for the
+    # local optimizations in the steady-state mode.
+    poll_interval = 1.0
+
+    def __init__(self, parameter_file, energy_function=None, selection=None,
+                 crossover=None, mutation=None):
+        """Read the parameters and prepare an empty run.
+
+        Args:
+            parameter_file (str)
+        Args(optional):
+            energy_function, selection, crossover, mutation: functions
+            replacing the defaults, see the class description
+        Raises:
+            ValueError: if children_per_generation is not a positive even
+            number
+        """
+        self.parameter_file = parameter_file
+        params = file2dict(parameter_file, ['GA settings', 'Run settings'])
+        # Set defaults for parameters not defined in the parameter file.
+        self.params = set_default(params, GeneticAlgorithm.dict_default)
+        if self.params['children_per_generation'] < 2 or \
+           self.params['children_per_generation'] % 2 != 0:
+            raise ValueError("The number of children per generation has to "
+                             "be a positive even number.")
+        if energy_function is None:
+            energy_function = detect_energy_function(self.params)
+        self.energy_function = energy_function
+        self.selection = selection
+        self.crossover = crossover
+        self.mutation = mutation
+        self.callbacks = {'structure': [], 'iteration': []}
+        self.mol = None
+        self.linked_params = {}
+        self.population = []
+        self.blacklist = Blacklist(
+            processes=self.params['blacklist_processes'])
+        self.min_energy = []
+        self.iteration = 0
+        self.finished = False
+        self.surrogate = None
+        if self.params['surrogate_candidates'] > 1:
+            self.surrogate = Surrogate(
+                regularization=self.params['surrogate_regularization'],
+                max_samples=self.params['surrogate_max_samples'])
+        self.island = None
+        if self.params['island_dir'] is not None:
+            # Exchange structures with the other islands via the shared
+            # directory.
+            if self.params['island_name'] is None:
+                self.params['island_name'] = os.path.basename(os.getcwd())
+            self.island = Island(self.params['island_dir'],
+                                 self.params['island_name'])
+
+    def add_callback(self, event, function):
+        """Call the function after each event ('structure' or 'iteration')."""
+        if event not in self.callbacks:
+            raise ValueError("Unknown event.")
+        self.callbacks[event].append(function)
+
+    def initialize(self):
+        """Build the molecule and the initial population. With more than one
+        relax process, all missing structures are generated first and relaxed
+        concurrently."""
+        params = self.params
+        self.mol = MoleculeDescription(self.parameter_file)
+        # Assign the permanent attributes to the molecule.
+        self.mol.get_parameters()
+        self.mol.create_template_sdf()
+        # Check for potential degree of freedom related parameters.
+        self.linked_params = find_linked_params(self.mol, params)
+        print_output("Number of atoms: "+str(self.mol.atoms))
+        print_output("Number of bonds: "+str(self.mol.bonds))
+        for dof in self.mol.dof_names:
+            print_output("Number of identified "+str(dof)+": " +
+                         str(len(getattr(self.mol, dof))))
+            print_output("Identified "+str(dof)+": " +
+                         str(getattr(self.mol, dof)))
+
+        print_output("___Initialization___")
+        cnt, cnt_relaxed = 0, 0
+        cnt_max = GeneticAlgorithm.cnt_max
+        try:
+            # Generate sensible and unique 3d structures.
+            while len(self.population) < params['popsize'] and cnt < cnt_max:
+                if params['relax_processes'] > 1:
+                    batch = params['popsize']-len(self.population)
+                else:
+                    batch = 1
+                candidates = []
+                while len(candidates) < batch and cnt < cnt_max:
+                    print_output("New trial")
+                    str3d = Structure(self.mol)
+                    str3d.generate_structure()
+                    cnt += 1
+                    if not str3d.is_geometry_valid():
+                        print_output("The geometry of "+str(str3d) +
+                                     " is invalid.")
+                        continue
+                    self._sync_blacklist()
+                    if str3d not in self.blacklist and \
+                       str3d not in candidates:
+                        candidates.append(str3d)
+                    else:
+                        print_output("Geomerty of "+str(str3d)+" is fine, "
+                                     "but already known.")
+                names = ["initial_%d" % i for i in
+                         range(cnt_relaxed, cnt_relaxed+len(candidates))]
+                cnt_relaxed += len(candidates)
+                unrelaxed = [Structure(str3d) for str3d in candidates]
+                # Perform the local optimization
+                self._optimize(candidates, names)
+                accepted = []
+                for str3d, before in zip(candidates, unrelaxed):
+                    str3d.send_to_blacklist(self.blacklist)
+                    # A candidate is discarded if it would have been rejected
+                    # after the relaxation of the preceding candidates.
+                    if before in accepted:
+                        print_output("Geomerty of "+str(str3d)+" was fine, "
+                                     "but turned out to be already known.")
+                        continue
+                    accepted.append(str3d)
+                    self.population.append(str3d)
+                    print_output(str(str3d)+", energy: " +
+                                 str(float(str3d)) +
+                                 ", was added to the population")
+                    relax_info(str3d)
+                    self._callback('structure', str3d)
+        except _Stop as exc:
+            print_output(exc)
+            self.finished = True
+            self.close()
+            return
+        if cnt == cnt_max:
+            print_output("The allowed number of trials for building the "
+                         "population has been exceeded. The code "
+                         "terminates.")
+            self.finished = True
+            self.close()
+            return
+        print_output("___Initialization completed___")
+        self.population.sort()
+        print_output("Initial population after sorting: ")
+        for i in range(len(self.population)):
+            print_output(str(self.population[i])+" " +
+                         str(float(self.population[i])))
+        self.min_energy.append(self.population[0].energy)
+        print_output("Blacklist: " + ', '.join([str(v)
+                                                for v in self.blacklist]))
+        self.iteration = 0
+
+    def restart(self):
+        """Reconstruct the molecule, population, blacklist and the state of
+        the run from the backup files."""
+        print_output(" \n ___Restart will be performed___")
+        with open("backup_mol.dat", 'r') as inf:
+            self.mol = eval(inf.readline(),
+                            {'MoleculeDescription': MoleculeDescription})
+        inf.close()
+        names = {'Structure': Structure, 'mol': self.mol}
+        with open("backup_population.dat", 'r') as inf:
+            for line in inf:
+                self.population.append(eval(line, names))
+        inf.close()
+        with open("backup_blacklist.dat", 'r') as inf:
+            for line in inf:
+                self.blacklist.append(eval(line, names))
+        inf.close()
+        with open("backup_min_energy.dat", 'r') as inf:
+            for line in inf:
+                self.min_energy.append(eval(line))
+        inf.close()
+        with open("backup_iteration.dat", 'r') as inf:
+            iteration_tmp = eval(inf.readline())
+        inf.close()
+        self.linked_params = find_linked_params(self.mol, self.params)
+        self.population.sort()
+        for i in range(len(self.population)):
+            print_output(str(self.population[i])+" " +
+                         str(float(self.population[i])))
+        print_output("Blacklist: " + ', '.join([str(v)
+                                                for v in self.blacklist]))
+        self.iteration = iteration_tmp+1
+        if self.island is not None and os.path.isfile("backup_island.dat"):
+            with open("backup_island.dat", 'r') as inf:
+                self.island.offset = eval(inf.readline())
+            inf.close()
+        print_output(" \n ___Reinitialization completed___")
+        for d in glob.glob('generation_'+str(self.iteration)+'_child*'):
+            remover_dir(d)
+
+    def run(self):
+        """Perform iterations until the run is finished (in the steady-state
+        mode if steady_state is set)."""
+        try:
+            if self.params['steady_state']:
+                try:
+                    self._steady_state()
+                except _Stop as exc:
+                    print_output(exc)
+                    self.finished = True
+            else:
+                while self.step():
+                    pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the worker processes of the blacklist (if any). This is done
+        automatically at the end of run() and of the last step(); the
+        workers are started again if the engine is used afterwards."""
+        self.blacklist.close()
+
+    def step(self):
+        """Perform one iteration: create children_per_generation children,
+        relax them (concurrently with more than one relax process), merge
+        them into the population and remove the same number of structures
+        with the highest energy.
+
+        Returns:
+            True if the run can be continued
+        Raises:
+            ValueError: if steady_state is set (the steady-state mode has no
+            separate iterations and is only available via run())
+        """
+        if self.params['steady_state']:
+            raise ValueError("The steady-state mode can only be performed "
+                             "with run().")
+        if self.finished or self.iteration >= self.params['max_iter']:
+            return False
+        print_output(" \n ___Start of iteration " + str(self.iteration) +
+                     "___")
+        try:
+            self._sync_blacklist()
+            self._train_surrogate()
+            selected = []
+            if self._batch_screening():
+                for pair in range(self.params['children_per_generation']//2):
+                    selected.extend(self._new_children(2*pair+1, selected))
+            else:
+                children = []
+                for pair in range(self.params['children_per_generation']//2):
+                    children.extend(self._create_pair())
+                for i in range(len(children)):
+                    selected.extend(self._prescreen(children[i],
+                                                    "child%d" % (i+1),
+                                                    selected))
+            children = selected
+            names = ["generation_%d_child%d" % (self.iteration, i+1)
+                     for i in range(len(children))]
+            self._optimize(children, names)
+            for child in children:
+                self._add_to_population(child)
+            self.population.sort()
+            print_output("Sorted population: " + ', '.join([
+                str(v) for v in self.population]))
+            del self.population[-len(children):]
+            print_output("Sorted population after removing %d structures "
+                         "with highest energy: " % len(children) +
+                         ', '.join([str(v) for v in self.population]))
+            self._finish_iteration()
+        except _Stop as exc:
+            print_output(exc)
+            self.finished = True
+        if not self.finished:
+            self.iteration += 1
+        else:
+            self.close()
+        return not self.finished
+
+    def _callback(self, event, *args):
+        for function in self.callbacks[event]:
+            function(self, *args)
+
+    def _check_for_kill(self):
+        if kill_requested():
+            raise _Stop("Kill.dat file discovered. The code terminates")
+
+    def _sync_blacklist(self):
+        if self.island is not None:
+            self.island.sync_blacklist(self.blacklist, self.mol)
+
+    def _train_surrogate(self):
+        """Retrain the surrogate model if new structures have been added to
+        the blacklist."""
+        if self.surrogate is None:
+            return
+        samples = self.surrogate.samples
+        self.surrogate.train(self.blacklist)
+        if self.surrogate.samples != samples and \
+           self.surrogate.is_trained():
+            print_output("Surrogate model trained on %d structures, "
+                         "leave-one-out RMSE: %.3f" %
+                         (self.surrogate.size, self.surrogate.loo_error()))
+
+    def _optimize(self, structures, names):
+        """Relax the structures (concurrently with more than one relax
+        process)."""
+        optimize_all(structures, names, self.energy_function, self.params,
+                     self.params['relax_processes'])
+        self._check_for_kill()
+
+    def _select(self):
+        """Return two parents."""
+        if self.selection is not None:
+            return self.selection(self.population)
+        (parent1, parent2, fitness) = selection(
+            self.population, self.params['selection'],
+            self.params['energy_var'], self.params['fitness_sum_limit'])
+        return parent1, parent2
+
+    def _create_pair(self):
+        """Select two parents and create two children via crossover (or as
+        copies of the parents)."""
+        parent1, parent2 = self._select()
+        param = np.random.rand()
+        cnt = 0
+        while param < self.params['prob_for_crossing'] and \
+                cnt < GeneticAlgorithm.cnt_max:
+            if self.crossover is not None:
+                child1, child2 = self.crossover(parent1, parent2)
+            else:
+                child1, child2 = Structure.crossover(parent1, parent2)
+            if child1.is_geometry_valid() and child2.is_geometry_valid():
+                print_output("Crossover outcome: "+str(child1)+(", ") +
+                             str(child2))
+                break
+            else:
+                print_output("The geometries created via crossover are "
+                             "invalid.")
+                cnt += 1
+                continue
+        else:
+            child1, child2 = Structure(parent1), Structure(parent2)
+            print_output("No crossover was performed. Children are copies of "
+                         "parents: " + str(child1) + (": ") + str(child1) +
+                         (", ") + str(child2) + (": ") + str(child2))
+            # Delete inherited attributes.
+            for child in child1, child2:
+                attr_list = ["initial_sdf_string", "energy"]
+                for attr in attr_list:
+                    delattr(child, attr)
+                for dof in child.dof:
+                    delattr(dof, "initial_values")
+
+        str_info(child1)
+        str_info(child2)
+        return [child1, child2]
+
+    def _mutate(self, candidate, name, pending):
+        """Mutate the candidate until it is valid and neither in the
+        blacklist nor equal to one of the pending (not yet relaxed)
+        children."""
+        print_output("__%s__" % name)
+        cnt = 0
+        while cnt < GeneticAlgorithm.cnt_max:
+            candidate_backup = Structure(candidate)
+            if self.mutation is not None:
+                self.mutation(candidate)
+            else:
+                candidate.mutate(**self.linked_params)
+            print_output("%s after mutation: " % name + str(candidate))
+            str_info(candidate)
+            if not candidate.is_geometry_valid():
+                print_output(" The geometry of %s is invalid." % name)
+                cnt += 1
+                # Rebuild the structure
+                candidate = candidate_backup
+                continue
+
+            if candidate not in self.blacklist and candidate not in pending:
+                return candidate
+            else:
+                print_output("Geomerty of "+str(candidate)+" is fine, but "
+                             "already known.")
+                cnt += 1
+                candidate = candidate_backup
+        raise _Stop("The allowed number of trials for generating"
+                    " a unique child has been exceeded.")
+
+    def _prescreen(self, child, name, pending):
+        """Create mutated candidates from the child and return the ones to be
+        relaxed with the energy function.
+
+        If the surrogate model is trained, surrogate_candidates candidates
+        are created (see _screen; as structures if a mutation function is
+        given; without custom operators the whole pair of children is
+        created in batches instead, see _screen_pair) and the
+        prescreen_candidates ones with the lowest predicted energy are
+        kept. Out of the prescreen_candidates
+        candidates, the one with the lowest force-field energy or, if
+        prescreen_window [eV] is set, all within the window above it are
+        selected. The force-field energies are obtained with prescreen_steps
+        steps of optimization (a single point energy for 0 steps) with
+        prescreen_force_field; the candidates themselves are not changed."""
+        params = self.params
+        trained = self.surrogate is not None and self.surrogate.is_trained()
+        if trained:
+            number = max(params['surrogate_candidates'],
+                         params['prescreen_candidates'])
+        else:
+            number = params['prescreen_candidates']
+        if trained and self.mutation is None:
+            candidates = self._screen(child, name, pending)
+        elif number == 1:
+            return [self._mutate(child, name, pending)]
+        else:
+            candidates = []
+            for i in range(number):
+                candidates.append(self._mutate(Structure(child), name,
+                                               pending+candidates))
+        if trained and self.mutation is not None:
+            predicted = self.surrogate.predict(candidates)
+            print_output("Surrogate model for %s, predicted energies: " %
+                         name + ', '.join(["%s: %.3f" % (str(candidate),
+                                                         energy)
+                                           for candidate, energy in
+                                           zip(candidates, predicted)]))
+            order = np.argsort(predicted,
+                               kind='mergesort')[:params[
+                                   'prescreen_candidates']]
+            candidates = [candidates[i] for i in order]
+            for i, candidate in zip(order, candidates):
+                candidate._predicted_energy = float(predicted[i])
+        return self._force_field_screen(candidates, name)
+
+    def _force_field_screen(self, candidates, name):
+        """Return the candidates for the child to be relaxed (see
+        _prescreen)."""
+        params = self.params
+        if len(candidates) == 1:
+            print_output("Selected for the relaxation: "+str(candidates[0]))
+            return candidates
+        energies = []
+        for candidate in candidates:
+            ff_object = FFObject(params['prescreen_force_field'],
+                                 steps=params['prescreen_steps'])
+            ff_object.run_ff(candidate.sdf_string)
+            energies.append(ff_object.get_energy())
+        print_output("Pre-screening of %s, force-field energies: " % name +
+                     ', '.join(["%s: %.3f" % (str(candidate), energy)
+                                for candidate, energy in zip(candidates,
+                                                             energies)]))
+        if params['prescreen_window'] is None:
+            selected = [candidates[int(np.argmin(energies))]]
+        else:
+            selected = [candidate for candidate, energy in zip(candidates,
+                                                               energies)
+                        if energy <= min(energies) +
+                        params['prescreen_window']]
+        print_output("Selected for the relaxation: " +
+                     ', '.join([str(candidate) for candidate in selected]))
+        return selected
+
+    def _batch_screening(self):
+        """Return True if the children are created in batches as arrays of
+        values and ranked with the surrogate model (see _screen_pair)."""
+        return self.surrogate is not None and \
+            self.surrogate.is_trained() and self.crossover is None and \
+            self.mutation is None
+
+    def _new_children(self, first, pending):
+        """Create a pair of children (named child<first> and
+        child<first+1>) and return the structures to be relaxed."""
+        names = ["child%d" % first, "child%d" % (first+1)]
+        selected = []
+        if self._batch_screening():
+            for name, candidates in zip(names,
+                                        self._screen_pair(names, pending)):
+                selected.extend(self._force_field_screen(candidates, name))
+        else:
+            for child, name in zip(self._create_pair(), names):
+                selected.extend(self._prescreen(child, name,
+                                                pending+selected))
+        return selected
+
+    def _screen_pair(self, names, pending):
+        """Select two parents and create surrogate_candidates pairs of
+        children from them as arrays of values in one call (crossover with
+        the probability prob_for_crossing, followed by mutation, see
+        Population). The candidates are ranked with the surrogate model and
+        the structures are built in the order of the predicted energy until
+        prescreen_candidates valid ones, that are neither in the blacklist
+        nor pending, are found for each of the two children. If none is
+        found for a child, it is created as in _create_pair and _mutate.
+
+        Returns:
+            two lists of candidates
+        """
+        params = self.params
+        parent1, parent2 = self._select()
+        population = Population(self.mol, [parent1, parent2])
+        number = params['surrogate_candidates']
+        values1, values2 = population.crossover(np.zeros(number, dtype=int),
+                                                np.ones(number, dtype=int))
+        # Children without crossover are copies of the parents.
+        copies = np.random.rand(number) >= params['prob_for_crossing']
+        values1[copies] = population.values[0]
+        values2[copies] = population.values[1]
+        values = population.mutate(np.vstack((values1, values2)),
+                                   **self.linked_params)
+        predicted = self.surrogate.predict_values(values, population.layout)
+        order = np.argsort(predicted, kind='mergesort')
+        print_output("Surrogate model for %s and %s (parents: %s, %s): %d "
+                     "candidates, predicted energies from %.3f to %.3f" %
+                     (names[0], names[1], str(parent1), str(parent2),
+                      len(values), predicted[order[0]],
+                      predicted[order[-1]]))
+        groups = [[], []]
+        for i in order:
+            ind = 0 if len(groups[0]) < params['prescreen_candidates'] else 1
+            candidate = population.materialize(values[i])
+            if not candidate.is_geometry_valid() or \
+               candidate in self.blacklist or \
+               candidate in pending+groups[0]+groups[1]:
+                continue
+            print_output("%s: " % names[ind] + str(candidate) +
+                         ", predicted energy: %.3f" % predicted[i])
+            str_info(candidate)
+            candidate._predicted_energy = float(predicted[i])
+            groups[ind].append(candidate)
+            if len(groups[1]) == params['prescreen_candidates']:
+                return groups
+        children = None
+        for ind in range(2):
+            if not groups[ind]:
+                # Continue as without the surrogate model (up to cnt_max
+                # trials).
+                print_output("None of the candidates for %s is valid and "
+                             "unknown." % names[ind])
+                if children is None:
+                    children = self._create_pair()
+                candidate = self._mutate(children[ind], names[ind],
+                                         pending+groups[0]+groups[1])
+                candidate._predicted_energy = float(
+                    self.surrogate.predict([candidate])[0])
+                groups[ind].append(candidate)
+        return groups
+
+    def _screen(self, child, name, pending):
+        """Create surrogate_candidates mutations of the child as arrays of
+        values (see Population), rank them with the surrogate model and build
+        the structures in the order of the predicted energy until
+        prescreen_candidates valid ones, that are neither in the blacklist
+        nor pending, are found. If none is found, the child is mutated as
+        in _mutate (which gives up after cnt_max trials)."""
+        params = self.params
+        population = Population(self.mol, [child])
+        values = population.mutate(np.repeat(population.values,
+                                             params['surrogate_candidates'],
+                                             axis=0), **self.linked_params)
+        predicted = self.surrogate.predict_values(values, population.layout)
+        order = np.argsort(predicted, kind='mergesort')
+        print_output("Surrogate model for %s: %d candidates, predicted "
+                     "energies from %.3f to %.3f" %
+                     (name, len(values), predicted[order[0]],
+                      predicted[order[-1]]))
+        selected = []
+        for i in order:
+            candidate = population.materialize(values[i], child.coords)
+            if not candidate.is_geometry_valid() or \
+               candidate in self.blacklist or \
+               candidate in pending+selected:
+                continue
+            print_output("%s after mutation: " % name + str(candidate) +
+                         ", predicted energy: %.3f" % predicted[i])
+            str_info(candidate)
+            candidate._predicted_energy = float(predicted[i])
+            selected.append(candidate)
+            if len(selected) == params['prescreen_candidates']:
+                return selected
+        if not selected:
+            # Continue with single mutations (up to cnt_max trials).
+            print_output("None of the candidates for %s is valid and "
+                         "unknown." % name)
+            candidate = self._mutate(child, name, pending)
+            candidate._predicted_energy = float(
+                self.surrogate.predict([candidate])[0])
+            selected.append(candidate)
+        return selected
+
+    def _add_to_population(self, child):
+        """Add the relaxed child to the blacklist and to the population."""
+        child.send_to_blacklist(self.blacklist)
+        if hasattr(child, "_predicted_energy"):
+            self.surrogate.record(child._predicted_energy, child.energy)
+            del child._predicted_energy
+        print_output(str(child)+":, energy: "+str(float(
+            child))+", is temporary added to the population")
+        relax_info(child)
+        self.population.append(child)
+        self._callback('structure', child)
+
+    def _finish_iteration(self):
+        """Exchange structures with the other islands (every
+        migration_interval iterations), report the state of the population,
+        perform the backup and check for convergence after an iteration."""
+        params = self.params
+        if self.island is not None:
+            self._sync_blacklist()
+            if self.iteration % params['migration_interval'] == \
+               params['migration_interval']-1:
+                for structure in self.island.migrate(
+                        self.population, params['migration_size'], self.mol):
+                    print_output(str(structure)+", energy: " +
+                                 str(float(structure))+", immigrated from "
+                                 "another island")
+        self.min_energy.append(self.population[0].energy)
+        print_output("Lowest energy of the population: %.3f" %
+                     self.min_energy[-1])
+        print_output("Lowest energies in run: "+str(self.min_energy))
+        if self.surrogate is not None and \
+           self.surrogate.prediction_error() is not None:
+            print_output("Surrogate model, RMSE of %d predictions: %.3f" %
+                         (len(self.surrogate.predictions),
+                          self.surrogate.prediction_error()))
+        perform_backup(self.mol, self.population, self.blacklist,
+                       self.iteration, self.min_energy)
+        if self.island is not None:
+            backup("backup_island.dat", self.island.offset)
+        self._callback('iteration')
+        if is_converged(self.iteration, params, self.min_energy):
+            self.finished = True
+            return
+        self._check_for_kill()
+
+    def _steady_state(self):
+        """Keep relax_processes local optimizations running. As soon as one
+        of them finishes, the child is added to the population (replacing the
+        structure with the highest energy) and new children are created from
+        the current population. An iteration is completed after
+        children_per_generation optimizations."""
+        params = self.params
+        done = Queue.Queue()
+        pool = multiprocessing.Pool(params['relax_processes'])
+        running, waiting = {}, []
+        cnt_child, cnt_relaxed = 0, 0
+        try:
+            while not self.finished and \
+                    self.iteration < params['max_iter']:
+                while len(running) < params['relax_processes']:
+                    if not waiting:
+                        print_output(" \n ___Creating children in "
+                                     "iteration " + str(self.iteration) +
+                                     "___")
+                        self._sync_blacklist()
+                        self._train_surrogate()
+                        pending = list(running.values())
+                        for selected in self._new_children(cnt_child+1,
+                                                           pending):
+                            cnt_child += 1
+                            waiting.append((selected,
+                                            "generation_%d_child%d" %
+                                            (self.iteration, cnt_child)))
+                    child, name = waiting.pop(0)
+                    running[name] = child
+                    optimize_async(pool, child, name, self.energy_function,
+                                   params, lambda result, name=name:
+                                   done.put((name, result)))
+                # Wait with a timeout, so that a kill.dat file (e.g. if a
+                # worker died and its result never arrives) and Ctrl-C are
+                # noticed.
+                while True:
+                    try:
+                        name, result = done.get(
+                            timeout=GeneticAlgorithm.poll_interval)
+                        break
+                    except Queue.Empty:
+                        self._check_for_kill()
+                child = running.pop(name)
+                collect_optimized(child, name, result)
+                self._check_for_kill()
+                self._add_to_population(child)
+                self.population.sort()
+                del self.population[-1]
+                print_output("Population after adding "+str(child)+": " +
+                             ', '.join([str(v) for v in self.population]))
+                cnt_relaxed += 1
+                if cnt_relaxed == params['children_per_generation']:
+                    self._finish_iteration()
+                    if not self.finished:
+                        self.iteration += 1
+                    cnt_child, cnt_relaxed = 0, 0
+        finally:
+            pool.terminate()
+            pool.join()
+            for name in running:
+                remover_dir(name+'_work')
@@ -22,10 +22,9 @@ import random
 
 from utilities import (
     find_closest,
-    find_one_in_list,
-    find_two_in_list,
     print_output
 )
+from sampler import WeightedSampler, weighted_sampler
 
 
 def selection(pop_list, selection_type, energy_range, fitness_sum_limit):
@@ -63,7 +62,7 @@ def selection(pop_list, selection_type, energy_range, fitness_sum_limit):
     fitness_sum = fitness.sum()
     if selection_type == "roulette_wheel":
         if fitness_sum > fitness_sum_limit:
-            x, y = find_two_in_list(fitness_sum, fitness)
+            x, y = WeightedSampler(fitness).draw_two()
             parent1 = pop_list[x]
             parent2 = pop_list[y]
         else:  # if the sum is below the limit, best and a random are selected
@@ -74,7 +73,7 @@ def selection(pop_list, selection_type, energy_range, fitness_sum_limit):
             fitness_rev = np.zeros(len(fitness))
             for i in range(len(fitness)):
                 fitness_rev[-(i+1)] = fitness[i]  # swapping of fitness values
-            x, y = find_two_in_list(fitness_sum, fitness_rev)
+            x, y = WeightedSampler(fitness_rev).draw_two()
             parent1 = pop_list[x]
             parent2 = pop_list[y]
         else:
@@ -103,20 +102,12 @@ def crossover(list1, list2):
     d = len(list1)
     if d > 0:
         cross_point = int(np.ceil(np.random.rand()*d)-1)
-        start1 = list1[:cross_point]
-        ind = 0
-        end1 = np.zeros(d - cross_point)
-        for n in range(len(end1)):
-            end1[ind] = list2[cross_point+n]
-            ind += 1
-        start2 = list2[:cross_point]
-        ind = 0
-        end2 = np.zeros(d - cross_point)
-        for n in range(len(end2)):
-            end2[ind] = list1[cross_point+n]
-            ind += 1
-        new_list1 = list(np.append(start1, end1))
-        new_list2 = list(np.append(start2, end2))
+        array1 = np.asarray(list1, dtype=float)
+        array2 = np.asarray(list2, dtype=float)
+        new_list1 = list(np.concatenate((array1[:cross_point],
+                                         array2[cross_point:])))
+        new_list2 = list(np.concatenate((array2[:cross_point],
+                                         array1[cross_point:])))
         return new_list1, new_list2
     else:
         return list1, list2
@@ -143,6 +134,8 @@ def mutation(list_for_mut, max_mutations, options, weights=None,
         raise ValueError("The max. number of mutations cannot be negative")
     mut_numb = random.randint(1, min(max_mutations, len(list_for_mut)))
     pos = random.sample(range(len(list_for_mut)), mut_numb)
+    if weights is not None:
+        sampler = weighted_sampler(weights)
     for p in pos:
         current_value = list_for_mut[p]
         banned = find_closest(current_value, options, periodic)
@@ -151,7 +144,7 @@ def mutation(list_for_mut, max_mutations, options, weights=None,
             if weights is None:
                 new_value = random.sample(options, 1)[0]
             else:
-                new_value = options[find_one_in_list(sum(weights), weights)]
+                new_value = options[sampler.draw()]
 
             if len(banned) != len(options):
                 if new_value not in banned:
@@ -16,10 +16,16 @@
 #   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
 ''' Communicate between the structure and the degrees of freedom.'''
 from __future__ import division
+import numpy as np
 from rdkit import Chem
 from rdkit.Chem import AllChem
 from deg_of_freedom import Torsion, CisTrans, PyranoseRing
-from utilities import check_geo_sdf
+from measure import pyranosering_carried_atoms
+from utilities import check_geo_sdf, find_carried_atoms, print_output
+
+# Maximal number of symmetry-equivalent atom mappings. Each mapping takes
+# 4 bytes per atom.
+MAX_SYMMETRY_MAPS = 1000000
 
 
 def get_atoms_and_bonds(smiles):
@@ -85,6 +91,66 @@ def get_positions(type_of_deg, smiles, **kwargs):
             return PyranoseRing.find(smiles)
 
 
+def get_carried_atoms(type_of_deg, smiles, positions):
+    """Find the atoms that are moved when the degree of freedom is set. The
+    topology is fixed, so this needs to be done only once per molecule.
+
+    Args:
+        type_of_deg (str)
+        smiles (str)
+        positions (list)
+    Returns:
+        list with an entry for each position: a numpy array of atom indices
+        (torsion, cistrans) or a list of five such arrays, one for each
+        rotated ring bond (pyranosering)
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError("The smiles is invalid")
+    mol = Chem.AddHs(mol)
+    neighbors = [[x.GetIdx() for x in atom.GetNeighbors()]
+                 for atom in mol.GetAtoms()]
+    if type_of_deg in ["torsion", "cistrans"]:
+        return [find_carried_atoms(neighbors, pos[1], pos[2])
+                for pos in positions]
+    if type_of_deg == "pyranosering":
+        return [pyranosering_carried_atoms(neighbors, pos)
+                for pos in positions]
+
+
+def get_symmetry_maps(smiles, heavy_atoms=False):
+    """Find the symmetry-equivalent atom mappings, i.e. all matches of the
+    molecular graph onto itself.
+
+    Args(required):
+        smiles (str)
+    Args(optional):
+        heavy_atoms (bool): if True, only the heavy atoms are considered
+        (they come first in the atom order)
+    Returns:
+        numpy array of shape (number of mappings, atoms); the atom i is
+        mapped onto the atom maps[k, i] by the k-th mapping. At most
+        MAX_SYMMETRY_MAPS mappings are returned; if there are more, a warning
+        is printed, as the Cartesian RMSD can be too high without the
+        missing mappings.
+    """
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError("The smiles is invalid")
+    if not heavy_atoms:
+        mol = Chem.AddHs(mol)
+    matches = mol.GetSubstructMatches(mol, uniquify=False,
+                                      maxMatches=MAX_SYMMETRY_MAPS)
+    if len(matches) == MAX_SYMMETRY_MAPS:
+        print_output("Warning: the number of symmetry-equivalent atom "
+                     "mappings reached the limit of %d. Only these are "
+                     "used for the cartesian RMSD, so equivalent "
+                     "structures may be treated as different. Consider "
+                     "rmsd_heavy_atoms=True or "
+                     "rmsd_type=\"internal_coord\"." % MAX_SYMMETRY_MAPS)
+    return np.array(matches, dtype=np.int32)
+
+
 def create_dof_object(type_of_deg, positions):
     """Initialize the degree of freedom from the positions
 
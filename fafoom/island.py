@@ -0,0 +1,161 @@
+#    Copyright 2015 Adriana Supady
+#
+#    This file is part of fafoom.
+#
+#   Fafoom is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Fafoom is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
+''' Exchange of structures between independent GA runs (islands) '''
+from __future__ import division
+import fcntl
+import glob
+import os
+
+from structure import Structure
+
+
+class Island(object):
+    """Connection of a GA run (island) to a directory shared by all islands.
+
+    The islands exchange structures via files in the shared directory (one
+    object representation per line, as in the backup files). Access to the
+    files is serialized with a lock file (fcntl), so that the directory may
+    reside on a filesystem shared between nodes:
+
+    * 'blacklist.dat': every island appends the structures it adds to its
+      blacklist and reads the ones appended by the other islands.
+    * 'best_<name>.dat': the best structures of the island, replaced during
+      each migration.
+    """
+    def __init__(self, directory, name, offset=0):
+        """Connect to the shared directory (create it if needed).
+
+        Args:
+            directory (str): shared directory
+            name (str): name of the island, unique among the islands
+        Args(optional):
+            offset (int): position in the shared blacklist file up to which
+            the entries have already been read (for a restart)
+        """
+        self.directory = directory
+        self.name = name
+        self.offset = offset
+        self._known = None
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def _lock(self):
+        """Return the opened and locked lock file."""
+        lockfile = open(os.path.join(self.directory, "lock"), 'a')
+        fcntl.lockf(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    @staticmethod
+    def _unlock(lockfile):
+        fcntl.lockf(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+
+    def sync_blacklist(self, blacklist, mol):
+        """Write the structures added to the blacklist since the last call to
+        the shared blacklist and add the structures written there by the
+        other islands to the blacklist.
+
+        Args:
+            blacklist: Blacklist (or list) of the island
+            mol: MoleculeDescription object
+        """
+        if self._known is None:
+            self._known = len(blacklist)
+        own = [blacklist[i] for i in range(self._known, len(blacklist))]
+        filename = os.path.join(self.directory, "blacklist.dat")
+        lockfile = self._lock()
+        try:
+            if own:
+                with open(filename, 'a') as outf:
+                    for structure in own:
+                        outf.write("%s\t%s\n" % (self.name, repr(structure)))
+            lines = []
+            if os.path.isfile(filename):
+                with open(filename, 'r') as inf:
+                    inf.seek(self.offset)
+                    lines = inf.readlines()
+                    self.offset = inf.tell()
+        finally:
+            self._unlock(lockfile)
+        for line in lines:
+            name, representation = line.rstrip('\n').split('\t', 1)
+            if name != self.name:
+                blacklist.append(_from_repr(representation, mol))
+        self._known = len(blacklist)
+
+    def migrate(self, population, size, mol):
+        """Publish the best structures of the population and add the best
+        structures of the other islands that are not equal to a member of the
+        population. The population keeps its size, i.e. the structures with
+        the highest energy are removed.
+
+        Args:
+            population (list): sorted population of the island
+            size (int): number of structures to publish
+            mol: MoleculeDescription object
+        Returns:
+            list of the structures that have been added
+        """
+        popsize = len(population)
+        filename = os.path.join(self.directory, "best_%s.dat" % self.name)
+        lockfile = self._lock()
+        try:
+            with open(filename+".tmp", 'w') as outf:
+                for structure in population[:size]:
+                    outf.write("%s\n" % repr(structure))
+            os.rename(filename+".tmp", filename)
+            lines = []
+            for other in sorted(glob.glob(os.path.join(self.directory,
+                                                       "best_*.dat"))):
+                if other != filename:
+                    with open(other, 'r') as inf:
+                        lines.extend(inf.readlines())
+        finally:
+            self._unlock(lockfile)
+        added = []
+        for line in lines:
+            structure = _from_repr(line.rstrip('\n'), mol)
+            # The structures of the other islands are usually already in the
+            # blacklist (see sync_blacklist), so they are compared with the
+            # population instead.
+            if _relaxed_geometry(structure) not in population:
+                population.append(structure)
+                added.append(structure)
+        population.sort()
+        del population[popsize:]
+        return added
+
+
+def _from_repr(representation, mol):
+    """Rebuild a Structure object from its representation."""
+    return eval(representation, {'Structure': Structure, 'mol': mol})
+
+
+def _relaxed_geometry(structure):
+    """Return a copy of the relaxed structure without the geometry before
+    the local optimization, so that it can be compared with other relaxed
+    structures (see Structure.__eq__)."""
+    probe = Structure(structure)
+    del probe.initial_coords
+    for dof in probe.dof:
+        if hasattr(dof, "initial_values"):
+            delattr(dof, "initial_values")
+    return probe
@@ -22,7 +22,12 @@ import numpy as np
 from rdkit import Chem
 from rdkit.Chem import rdMolTransforms
 
-from utilities import get_vec, tor_rmsd, xyz2sdf
+from utilities import (
+    coords2sdf,
+    find_carried_atoms,
+    get_ind_from_sdfline,
+    sdf2coords
+)
 
 
 def ig(x):
@@ -50,6 +55,82 @@ def dihedral_measure(sdf_string, position):
     return float('{0:.2f}'.format(val))
 
 
+def dihedral_measure_coords(coords, positions):
+    """ Measure several dihedral angles at once (vectorized).
+
+    Args:
+        coords (numpy array): Cartesian coordinates, shape (atoms, 3)
+        positions (list or numpy array): 4 atoms defining each dihedral,
+        shape (dihedrals, 4)
+    Returns:
+        numpy array of values [deg], rounded to two decimals
+    Raises:
+        ValueError: If a position is not defined by 4 atoms.
+    """
+    positions = np.array(positions, dtype=int)
+    if positions.ndim != 2 or positions.shape[1] != 4:
+        raise ValueError("The position needs to be defined by 4 integers")
+    return np.round(dihedral_angles(coords, positions), 2)
+
+
+def dihedral_angles(coords, positions):
+    """ Return the unrounded dihedral angles [deg] for an (n, 4) numpy array
+    of atom indices. The coordinates can be of shape (atoms, 3) or stacked,
+    e.g. (structures, atoms, 3); the result has the shape (..., n)."""
+    p0, p1, p2, p3 = [coords[..., positions[:, i], :] for i in range(4)]
+    b1, b2, b3 = p1-p0, p2-p1, p3-p2
+    n1 = np.cross(b1, b2)
+    n2 = np.cross(b2, b3)
+    x = np.sum(n1*n2, axis=-1)
+    y = np.sqrt(np.sum(b2*b2, axis=-1))*np.sum(b1*n2, axis=-1)
+    return np.degrees(np.arctan2(y, x))
+
+
+def rotation_matrix(axis, angle):
+    """ Return the matrix for a rotation by angle [rad] around the axis
+    (closed-form Rodrigues formula)."""
+    x, y, z = axis/np.sqrt(np.dot(axis, axis))
+    c, s = np.cos(angle), np.sin(angle)
+    t = 1.0-c
+    return np.array([[t*x*x+c, t*x*y-s*z, t*x*z+s*y],
+                     [t*x*y+s*z, t*y*y+c, t*y*z-s*x],
+                     [t*x*z-s*y, t*y*z+s*x, t*z*z+c]])
+
+
+def dihedral_set_coords(coords, positions, values, carried_atoms,
+                        check=None):
+    """ Set several dihedral angles by rotating the precomputed moving
+    fragments around the central bonds.
+
+    Args(required):
+        coords (numpy array): Cartesian coordinates
+        positions (list): 4 atoms defining each dihedral
+        values (list): values to set
+        carried_atoms (list): numpy arrays with the indices of the atoms
+        moved with each dihedral, see utilities.find_carried_atoms
+    Args(optional):
+        check (function): called as check(coords, i) after the i-th dihedral
+        has been set; if it returns False, the remaining dihedrals are skipped
+    Returns:
+        new coordinates (numpy array) or None if the check failed
+    Raises:
+        ValueError: If the lengths of the lists differ.
+    """
+    if not len(positions) == len(values) == len(carried_atoms):
+        raise ValueError("No length match between the positions and values")
+    coords = np.array(coords, dtype=float)
+    for ind, (position, value, carried) in enumerate(zip(positions, values,
+                                                         carried_atoms)):
+        current = dihedral_angles(coords, np.array([position]))[0]
+        origin = coords[ig(2)(position)]
+        rot = rotation_matrix(origin-coords[ig(1)(position)],
+                              np.radians(value-current))
+        coords[carried] = np.dot(coords[carried]-origin, rot.T)+origin
+        if check is not None and not check(coords, ind):
+            return None
+    return coords
+
+
 def dihedral_set(sdf_string, position, value):
     """ Set the dihedral angle.
 
@@ -72,6 +153,42 @@ def dihedral_set(sdf_string, position, value):
     return Chem.MolToMolBlock(mol)
 
 
+def dihedral_set_on_conformer(conf, positions, values):
+    """ Set several dihedral angles on a RDKit conformer (in place).
+
+    Args:
+        conf: RDKit conformer (needs to be owned by a molecule)
+        positions (list): list of 4 atoms defining each dihedral
+        values (list): values to set
+    Raises:
+        ValueError: If the lengths of the lists differ or if a position is
+        not defined by 4 atoms.
+    """
+    if len(positions) != len(values):
+        raise ValueError("No length match between the positions and values")
+    for position, value in zip(positions, values):
+        if len(position) != 4:
+            raise ValueError("The position needs to be defined by 4 integers")
+        rdMolTransforms.SetDihedralDeg(conf, ig(0)(position),
+                                       ig(1)(position), ig(2)(position),
+                                       ig(3)(position), float(value))
+
+
+def dihedral_set_multiple(sdf_string, positions, values):
+    """ Set several dihedral angles with a single parse of the sdf string.
+
+    Args:
+        sdf_string (string)
+        positions (list): list of 4 atoms defining each dihedral
+        values (list): values to set
+    Returns:
+        modified sdf_string
+    """
+    mol = Chem.MolFromMolBlock(sdf_string, removeHs=False)
+    dihedral_set_on_conformer(mol.GetConformer(), positions, values)
+    return Chem.MolToMolBlock(mol)
+
+
 def pyranosering_set(sdf_string, position, new_dih, new_ang):
     """ Set the pyranosering.
 
@@ -87,6 +204,61 @@ def pyranosering_set(sdf_string, position, new_dih, new_ang):
         ValueError: If the lenght of the position is not equal 7 ot if the
         length of new_dih/new_ang is not equal to 5.
     """
+    if len(position) != 7:
+        raise ValueError("The position needs to be defined by 7 integers")
+    atoms, bonds = get_ind_from_sdfline(sdf_string.split('\n')[3])
+    neighbors = [[] for i in range(atoms)]
+    for line in sdf_string.split('\n')[4+atoms:4+atoms+bonds]:
+        at1, at2 = get_ind_from_sdfline(line)
+        neighbors[at1-1].append(at2-1)
+        neighbors[at2-1].append(at1-1)
+    carried_atoms = pyranosering_carried_atoms(neighbors, position)
+    coords = pyranosering_set_coords(sdf2coords(sdf_string), position,
+                                     new_dih, new_ang, carried_atoms)
+    return coords2sdf(coords, sdf_string)
+
+
+def pyranosering_carried_atoms(neighbors, position):
+    """ Find the atoms carried along when the ring bonds C1-C2, C2-C3, C3-C4,
+    C4-O and O-C0 are rotated (with the ring cut between C0 and C1).
+
+    Args:
+        neighbors (list): list of neighbor indices for each atom
+        position (list): 7 atoms defining the ring
+    Returns:
+        list of five numpy arrays with atom indices
+    """
+    ring = [ig(i)(position) for i in range(6)]+[ig(0)(position)]
+    return [find_carried_atoms(neighbors, ring[n+1], ring[n+2],
+                               cut_bonds=[(ring[0], ring[1])])
+            for n in range(5)]
+
+
+def pyranosering_set_coords(coords, position, new_dih, new_ang,
+                            carried_atoms):
+    """ Set the pyranosering on Cartesian coordinates.
+
+    The ring is cut between C0 and C1 and the five ring angles and the five
+    ring dihedrals (defined according to the IUPAC paper,
+    doi: 10.1016/S0040-4020(00)01019-X) are set one after another by
+    rotating the moving fragments. The rotations are measured and composed
+    on the ring atoms only; every group of atoms that shares the same set of
+    moving fragments is then transformed with a single matrix product.
+
+    Args:
+        coords (numpy array): Cartesian coordinates
+        position (list): 7 atoms defining the ring, i.e. positions of
+                        ['C0','C1','C2','C3','C4','O', 'O0']
+        new_dih (list) : 5 values for the dihedral angles
+        new_ang (list): 5 values for the bond angles
+        carried_atoms (list): atoms moved with the ring bonds, see
+        pyranosering_carried_atoms
+    Returns:
+        new coordinates (numpy array)
+    Raises:
+        ValueError: If the lenght of the position is not equal 7 ot if the
+        length of new_dih/new_ang is not equal to 5.
+    """
     if len(position) != 7:
         raise ValueError("The position needs to be defined by 7 integers")
     if len(new_dih) != 5:
@@ -95,281 +267,59 @@ def pyranosering_set(sdf_string, position, new_dih, new_ang):
     if len(new_ang) != 5:
         raise ValueError("Five bond angles are needed for the new ring "
                          "conformation.")
-
-    from scipy.linalg import expm3
-
-    atoms_ring = {}
-    for n, name in zip(range(len(position)),
-                       ['C0', 'C1', 'C2', 'C3', 'C4', 'O', 'O0']):
-        atoms_ring[name] = position[n]
-
-    def initialize(sdf_string):
-        molecule = Chem.MolFromMolBlock(sdf_string, removeHs=False)
-        return molecule
-
-    def calculate_normal_vector(list_of_atoms, xyz):
-        """Calculate the normal vector of a plane by
-        cross product of two vectors belonging to it.
-
-        Args:
-            list_of_atoms: list of 3 atoms
-            xyz: numpy array with atoms xyz position
-        """
-
-        r0 = xyz[list_of_atoms[1], :] - xyz[list_of_atoms[0], :]
-        r1 = xyz[list_of_atoms[2], :] - xyz[list_of_atoms[1], :]
-        cross_product = np.cross(r1, r0)
-
-        return cross_product
-
-    def measure_angle(list_of_atoms, xyz):
-        """Calculate an angle between three atoms:
-        angle = acos(dot(X,Y)/(norm(X)*norm(Y)))
-
-        Args:
-            list_of_atoms: list of 3 atoms
-            xyz: numpy array with atoms xyz positions
-        """
-
-        r0 = xyz[list_of_atoms[0], :] - xyz[list_of_atoms[1], :]
-        r1 = xyz[list_of_atoms[2], :] - xyz[list_of_atoms[1], :]
-
-        norm_r0 = np.sqrt(np.sum(r0**2))
-        norm_r1 = np.sqrt(np.sum(r1**2))
-        norm = norm_r0*norm_r1
-
-        dot_product = np.dot(r0, r1)/norm
-        angle = np.arccos(dot_product)
-
-        #Calculate the axis of rotation (axor):
-        axor = np.cross(r0, r1)
-
-        return angle*180.0/np.pi, axor
-
-    def measure_dihedral(list_of_atoms, xyz):
-        """Calculate a dihedral angle between two planes defined by
-        a list of four atoms. It returns the angle and the rotation axis
-        required to set a new dihedral.
-
-        Args:
-            list_of_atoms: list of 4 atoms
-            xyz: numpy array with atom xyz positions
-        """
-
-        plane1 = calculate_normal_vector(list_of_atoms[:3], xyz)
-        plane2 = calculate_normal_vector(list_of_atoms[1:], xyz)
-        #Calculate the axis of rotation (axor)
-        axor = np.cross(plane1, plane2)
-
-        #Calculate a norm of normal vectors:
-        norm_plane1 = np.sqrt(np.sum(plane1**2))
-        norm_plane2 = np.sqrt(np.sum(plane2**2))
-        norm = norm_plane1 * norm_plane2
-        #Measure the angle between two planes:
-        dot_product = np.dot(plane1, plane2)/norm
-        alpha = np.arccos(dot_product)
-
-        #The cosine function is symetric thus, to distinguish between
-        #negative and positive angles, one has to calculate if the fourth
-        #point is above or below the plane defined by first 3 points:
-        ppoint = - np.dot(plane1, xyz[list_of_atoms[0], :])
-        dpoint = (np.dot(plane1, xyz[list_of_atoms[3], :])+ppoint)/norm_plane1
-        if dpoint >= 0:
-            return -(alpha*180.0)/np.pi, axor
-        else:
-            return (alpha*180.0)/np.pi, axor
-
-    def determine_carried_atoms(at1, at2, conn_mat):
-        """Find all atoms necessary to be carried over during rotation
-        of an atom 2:
-
-        Args:
-            at1, at2: two atoms number
-        """
-
-        #1. Zero the connections in connectivity matrix
-        tmp_conn = np.copy(conn_mat)
-        tmp_conn[at1, at2] = 0
-        tmp_conn[at2, at1] = 0
-        #2. Determine the connected atoms:
-        carried_atoms = [at2]
-        s = True
-        while s:
-            s = False
-            #Always iterate over entire list because I might have branching
-            for at in carried_atoms:
-                #List of indexes of connected atoms:
-                conn_atoms = np.where(tmp_conn[at] != 0)[0]
-                conn_atoms.tolist
-                for x in conn_atoms:
-                    if x not in carried_atoms:
-                        carried_atoms.append(x)
-                        s = True
-        return carried_atoms
-
-    def set_angle(list_of_atoms, new_ang, atoms_ring, xyz, conn_mat):
-        """Set a new angle between three atoms
-
-        Args:
-            list_of_atoms: list of three atoms
-            new_ang: value of dihedral angle (in degrees) to be set
-            atoms_ring: dictionary of atoms in the ring. It recognizes
-                        if the last atom is 'C0O' (obsolete)
-            xyz: numpy array with atoms xyz positions
-            conn_mat: connectivity matrix
-        Returns:
-            xyz: modified numpy array with new atoms positions
-        """
-        #Determine the axis of rotation:
-        old_ang, axor = measure_angle(list_of_atoms, xyz)
-        norm_axor = np.sqrt(np.sum(axor**2))
-        normalized_axor = axor/norm_axor
-
-        #Determine which atoms should be dragged along with the bond:
-        carried_atoms = determine_carried_atoms(list_of_atoms[1],
-                                                list_of_atoms[2], conn_mat)
-
-        #Each carried_atom is rotated by euler-rodrigues formula:
-        #Also, I move the midpoint of the bond to the mid atom
-        #the rotation step and then move the atom back.
-
-        rot_angle = np.pi*(new_ang - old_ang)/180.
-        #Shake it, baby! Rotation matrix:
-        #print old_ang, new_ang, rot_angle*180./np.pi
-        rot1 = expm3(np.cross(np.eye(3), normalized_axor*rot_angle))
-        translation = xyz[list_of_atoms[1], :]
-        for at in carried_atoms:
-            xyz[at, :] = np.dot(rot1, xyz[at, :]-translation)
-            xyz[at, :] = xyz[at, :]+translation
-        return xyz
-
-    def set_dihedral(list_of_atoms, new_dih, atoms_ring, xyz, conn_mat):
-        """Set a new dihedral angle between two planes defined by
-        atoms first and last three atoms of the supplied list.
-
-        Args:
-            list_of_atoms: list of four atoms
-            new_dih: value of dihedral angle (in degrees) to be set
-            atoms_ring: dictionary of atoms in the ring. It recognizes
-                       if the last atom is 'C0O'
-            xyz: numpy array with atoms xyz positions
-            conn_mat: connectivity matrix
-        Returns:
-            xyz: modified numpy array with new atoms positions
-        """
-
-        #Determine the axis of rotation:
-        old_dih, axor = measure_dihedral(list_of_atoms, xyz)
-        norm_axor = np.sqrt(np.sum(axor**2))
-        normalized_axor = axor/norm_axor
-
-        #Check if the bond is the last bond, next to broken one.
-        #If yes, refer to the oxygen:
-        if 'O0a' in atoms_ring.keys():
-            if list_of_atoms[-1] == atoms_ring['O0a']:
-                new_dih += 120.0
-        else:
-            if list_of_atoms[-1] == atoms_ring['O0b']:
-                new_dih -= 120.0
-        #Determine which atoms should be dragged along with the bond:
-        carried_atoms = determine_carried_atoms(list_of_atoms[1],
-                                                list_of_atoms[2], conn_mat)
-        #Each carried_atom is rotated by Euler-Rodrigues formula:
-        #Reverse if the angle is less than zero, so it rotates in
-        #right direction.
-        #Also, I move the midpoint of the bond to the center for
-        #the rotation step and then move the atom back.
-
-        if old_dih >= 0.0:
-            rot_angle = np.pi*(new_dih - old_dih)/180.
-        else:
-            rot_angle = -np.pi*(new_dih - old_dih)/180.
-        #Shake it, baby! Rotation matrix:
-        rot1 = expm3(np.cross(np.eye(3), normalized_axor*rot_angle))
-        translation = (xyz[list_of_atoms[1], :]+xyz[list_of_atoms[2], :])/2
-        for at in carried_atoms:
-            xyz[at, :] = np.dot(rot1, xyz[at, :]-translation)
-            xyz[at, :] = xyz[at, :]+translation
-
-        return xyz
-
-    def mutate_ring(molecule, new_dih, new_ang):
-        """Mutate a ring to given conformation defined as a list of torsional
-        angles accoring to the 10.1016/S0040-4020(00)01019-X (IUPAC) paper
-        """
-        n_at = molecule.GetNumAtoms()
-        n_bonds = molecule.GetNumBonds()
-        m_string = Chem.MolToMolBlock(molecule)
-
-        #Split the string to xyz, connectivity matrix and atom list
-        m_coords = m_string.split('\n')[4:4+n_at]
-        xyz = np.zeros((n_at, 3))
-        atom_list = []
-        n = 0
-        for line in m_coords:
-            xyz[n, :] += np.array(map(float, line.split()[:3]))
-            atom_list.append(line.split()[3])
-            n += 1
-        #Molecule Connectivity Matrix
-        m_conn = m_string.split('\n')[4+n_at:4+n_at+n_bonds]
-        conn_mat = np.zeros((n_at, n_at))
-        for line in m_conn:
-            at1 = int(line.split()[0])
-            at2 = int(line.split()[1])
-            conn_mat[at1-1, at2-1] = 1
-            conn_mat[at2-1, at1-1] = 1
-
-        #Introduce a cut between ring C0 and C1:
-        #I chose these atoms according to the torsion
-        #definitions in the IUPAC paper
-        #doi: 10.1016/S0040-4020(00)01019-X
-        conn_mat[atoms_ring['C0'], atoms_ring['C1']] = 0
-        conn_mat[atoms_ring['C1'], atoms_ring['C0']] = 0
-
-        #Construct a list of atoms in order:
-        #C0, C1, C2, C3, C4, O, C0, O0a/b (oxygen at anomeric carbon)
-        #I use this list to rotate bonds.
-        atoms_list = []
-        for x in range(0, 5):
-            atoms_list.append(atoms_ring['C'+str(x)])
-        atoms_list.append(atoms_ring['O'])
-        atoms_list.append(atoms_ring['C0'])
-        atoms_list.append(atoms_ring['O0'])
-
-        #Determine the anomer - alpha/beta, based on improper
-        #dihedral angle C1-C0-O-O0
-        imdih = []
-        for at in ['C1', 'C0', 'O', 'O0']:
-            imdih.append(atoms_ring[at])
-        test_anomer = measure_dihedral(imdih, xyz)[0]
-        if test_anomer > 0.0:
-            atoms_ring['O0b'] = atoms_ring.pop('O0')
-        else:
-            atoms_ring['O0a'] = atoms_ring.pop('O0')
-
-        #Adjust the 'internal' angles in the ring:
-        for n in range(len(new_ang)):
-            xyz = set_angle(atoms_list[n:n+3], new_ang[n], atoms_ring, xyz,
-                            conn_mat)
-        #Rotate the dihedral angles in the ring:
-        for n in range(len(new_dih)):
-            xyz = set_dihedral(atoms_list[n:n+4], new_dih[n], atoms_ring, xyz,
-                               conn_mat)
-        a = []
-        a.append("%10s\n" % n_at)
-        for n in new_dih:
-            a.append("%10.4f" % n)
-        a.append("\n")
-        for n in range(n_at):
-            a.append("%10s%10.4f%10.4f%10.4f\n" % (atom_list[n], xyz[n, 0],
-                                                   xyz[n, 1], xyz[n, 2]))
-        xyz_string = ''.join(a)
-        return xyz_string
-
-    molecule = initialize(sdf_string)
-    sdf_string = xyz2sdf(mutate_ring(molecule, new_dih, new_ang), sdf_string)
-
-    return sdf_string
+    xyz = np.array(coords, dtype=float)
+
+    # Atoms in order: C0, C1, C2, C3, C4, O, C0, O0 (oxygen at the anomeric
+    # carbon); the atoms_list[n+1]-atoms_list[n+2] bond is rotated in step n.
+    atoms_list = [ig(i)(position) for i in range(6)]+[ig(0)(position),
+                                                      ig(6)(position)]
+    ring_atoms = sorted(set(atoms_list))
+    ring_xyz = xyz[ring_atoms]
+    row = dict((at, n) for n, at in enumerate(ring_atoms))
+    ring = [row[at] for at in atoms_list]
+
+    # Every atom is labelled with the bit pattern of the fragments carrying
+    # it; atoms with equal patterns undergo the same overall transformation.
+    pattern = np.zeros(len(xyz), dtype=int)
+    for n in range(5):
+        pattern[carried_atoms[n]] |= 1 << n
+    ring_pattern = pattern[ring_atoms]
+    groups = [p for p in np.unique(pattern) if p != 0]
+    transform = dict((p, (np.eye(3), np.zeros(3))) for p in groups)
+
+    # The dihedral next to the cut refers to the oxygen at C0, shifted
+    # depending on the anomer (improper dihedral C1-C0-O-O0).
+    test_anomer = dihedral_angles(ring_xyz, np.array([[ring[1], ring[0],
+                                                       ring[5], ring[7]]]))[0]
+    shift = -120.0 if test_anomer > 0.0 else 120.0
+
+    def rotate(n, axis, angle, origin):
+        rot = rotation_matrix(axis, np.radians(angle))
+        moved = (ring_pattern >> n) & 1 == 1
+        ring_xyz[moved] = np.dot(ring_xyz[moved]-origin, rot.T)+origin
+        for p in groups:
+            if (p >> n) & 1:
+                r, t = transform[p]
+                transform[p] = np.dot(rot, r), np.dot(rot, t-origin)+origin
+
+    for n in range(5):
+        i, j, k = ring[n:n+3]
+        r0, r1 = ring_xyz[i]-ring_xyz[j], ring_xyz[k]-ring_xyz[j]
+        cos_ang = np.dot(r0, r1)/np.sqrt(np.dot(r0, r0)*np.dot(r1, r1))
+        old_ang = np.degrees(np.arccos(np.clip(cos_ang, -1.0, 1.0)))
+        rotate(n, np.cross(r0, r1), new_ang[n]-old_ang, ring_xyz[j])
+    for n in range(5):
+        quad = np.array([ring[n:n+4]])
+        old_dih = dihedral_angles(ring_xyz, quad)[0]
+        new = new_dih[n]+shift if n == 4 else new_dih[n]
+        rotate(n, ring_xyz[ring[n+2]]-ring_xyz[ring[n+1]], new-old_dih,
+               ring_xyz[ring[n+2]])
+
+    for p in groups:
+        r, t = transform[p]
+        moved = pattern == p
+        xyz[moved] = np.dot(xyz[moved], r.T)+t
+    return xyz
 
 
 def pyranosering_measure(sdf_string, position, dict_of_options):
@@ -384,23 +334,54 @@ def pyranosering_measure(sdf_string, position, dict_of_options):
     Raises:
         ValueError: If the lenght of the position is not equal 7.
     """
-    if len(position) != 7:
-        raise ValueError("The position needs to be defined by 7 integers")
-    ang1 = dihedral_measure(sdf_string, position[0:4])
-    ang2 = dihedral_measure(sdf_string, position[1:5])
-    ang3 = dihedral_measure(sdf_string, position[2:6])
-    ang4 = dihedral_measure(sdf_string, (ig(3)(position), ig(4)(position),
-                                         ig(5)(position), ig(0)(position)))
-    ang5 = dihedral_measure(sdf_string, (ig(4)(position), ig(5)(position),
-                                         ig(0)(position), ig(1)(position)))
-    ang6 = dihedral_measure(sdf_string, (ig(5)(position), ig(0)(position),
-                                         ig(1)(position), ig(2)(position)))
+    return pyranosering_measure_coords(sdf2coords(sdf_string), position,
+                                       dict_of_options)
+
+
+def pyranosering_measure_coords(coords, position, dict_of_options):
+    """Assign the ring to a conformation from the dictionary of options.
 
-    all_ang = [ang1, ang2, ang3, ang4, ang5, ang6]
+    Args:
+        coords (numpy array): Cartesian coordinates
+        position (list): 7 atoms defining the ring
+        dict_of_options (dict) : options for the ring, keys are the string
+        representations of the integers 0..len(dict_of_options)-1
+    Returns:
+        An integer that corresponds to the best matching dict key
+    Raises:
+        ValueError: If the lenght of the position is not equal 7.
+    """
+    options = np.array([dict_of_options[str(i)]
+                        for i in range(len(dict_of_options))])
+    return int(pyranosering_classify(coords, [position], options)[0])
 
-    rmsd_dict = {}
 
-    for key in dict_of_options:
-        rmsd_dict[key] = (tor_rmsd(2, get_vec(all_ang, dict_of_options[key])))
+def pyranosering_classify(coords, positions, options):
+    """Assign rings to the closest conformations from an array of options.
+    The torsional RMSD of the six ring dihedrals to all options is computed
+    in one vectorized expression (see utilities.tor_rmsd).
 
-    return int(min(rmsd_dict.iteritems(), key=ig(1))[0])
+    Args:
+        coords (numpy array): Cartesian coordinates of shape (atoms, 3), or
+        stacked for several structures, e.g. (structures, atoms, 3)
+        positions (list): 7 atoms defining each ring
+        options (numpy array): ring dihedrals of the conformations, shape
+        (n_options, 6)
+    Returns:
+        numpy array of indices of the best matching options, shape
+        (..., rings)
+    Raises:
+        ValueError: If the lenght of a position is not equal 7.
+    """
+    for position in positions:
+        if len(position) != 7:
+            raise ValueError("The position needs to be defined by 7 "
+                             "integers")
+    ring_dihedrals = np.array([[position[(i+k) % 6] for k in range(4)]
+                               for position in positions for i in range(6)])
+    all_ang = np.round(dihedral_angles(coords, ring_dihedrals), 2)
+    all_ang = all_ang.reshape(all_ang.shape[:-1]+(len(positions), 1, 6))
+    diff = np.abs(all_ang-options)
+    diff = np.minimum(diff, np.abs(360-diff))/180.0
+    rmsd = np.sqrt(np.mean(diff**2, axis=-1))
+    return np.argmin(rmsd, axis=-1)
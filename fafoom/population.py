@@ -0,0 +1,175 @@
+#    Copyright 2015 Adriana Supady
+#
+#    This file is part of fafoom.
+#
+#   Fafoom is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Fafoom is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
+''' Population stored as arrays of the values of the degrees of freedom '''
+from __future__ import division
+import numpy as np
+
+from deg_of_freedom import Torsion, CisTrans, PyranoseRing
+from structure import Structure
+from sampler import weighted_sampler
+
+# Options for the values and periodicity for each type of degree of freedom.
+DOF_OPTIONS = {'torsion': (np.array(Torsion.values_options, dtype=float),
+                           True),
+               'cistrans': (np.array(CisTrans.values_options, dtype=float),
+                            True),
+               'pyranosering': (np.array(PyranoseRing.values_options,
+                                         dtype=float), False)}
+
+
+class Population(object):
+    """Values of the degrees of freedom of a set of structures, stored as a
+    (N, number of values) numpy array.
+
+    The values of all degrees of freedom of a structure form a row in the
+    order of mol.dof_names; layout holds the (dof type, start, stop) columns
+    of each degree of freedom. Crossover and mutation operate on whole
+    arrays of values at once, so that many candidates can be created (and
+    e.g. ranked with a surrogate model) without building their geometries.
+    Structure objects are only built with materialize.
+    """
+    def __init__(self, mol, structures=None):
+        """Args:
+            mol: MoleculeDescription object
+        Args(optional):
+            structures (list): Structure objects to be added
+        """
+        self.mol = mol
+        self.layout = []
+        start = 0
+        for dof_name in mol.dof_names:
+            stop = start+len(getattr(mol, dof_name))
+            self.layout.append((dof_name, start, stop))
+            start = stop
+        self.values = np.zeros((0, start))
+        if structures is not None:
+            self.extend(structures)
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, structures):
+        """Add the values of the structures."""
+        if not structures:
+            return
+        rows = np.array([np.concatenate([np.asarray(dof.values, dtype=float)
+                                         for dof in structure.dof])
+                         for structure in structures], dtype=float)
+        self.values = np.vstack((self.values, rows.reshape(
+            len(structures), self.values.shape[1])))
+
+    def crossover(self, parents1, parents2):
+        """Cross the rows parents1 with the rows parents2 (arrays of
+        indices). As in genetic_operations.crossover, a crossing point is
+        chosen at random for each degree of freedom and the values after it
+        are exchanged.
+
+        Returns:
+            two (len(parents1), number of values) numpy arrays of children
+        """
+        values1 = self.values[np.asarray(parents1, dtype=int)]
+        values2 = self.values[np.asarray(parents2, dtype=int)]
+        swap = np.zeros(values1.shape, dtype=bool)
+        for dof_type, start, stop in self.layout:
+            d = stop-start
+            if d == 0:
+                continue
+            cross_point = np.ceil(np.random.rand(len(values1))*d)-1
+            swap[:, start:stop] = np.arange(d) >= cross_point[:, np.newaxis]
+        return (np.where(swap, values2, values1),
+                np.where(swap, values1, values2))
+
+    def mutate(self, values, **kwargs):
+        """Return mutated copies of the rows of values (numpy array). Each
+        degree of freedom is mutated with the probability prob_for_mut_<dof>
+        (always if not given) with up to max_mutations_<dof> changed values
+        (default: half of the values); the new values are drawn from the
+        options (with the weights_<dof> of the molecule, if defined) but
+        never the option closest to the current value, as in
+        genetic_operations.mutation.
+
+        Args:
+            values (numpy array): (N, number of values)
+        Args(optional):
+            prob_for_mut_<dof>, max_mutations_<dof>: see Structure.mutate
+        """
+        values = np.array(values, dtype=float)
+        number = len(values)
+        for dof_type, start, stop in self.layout:
+            d = stop-start
+            if d == 0:
+                continue
+            options, periodic = DOF_OPTIONS[dof_type]
+            if 'prob_for_mut_'+dof_type in kwargs:
+                active = np.random.rand(number) < \
+                    kwargs['prob_for_mut_'+dof_type]
+            else:
+                active = np.ones(number, dtype=bool)
+            max_mutations = kwargs.get('max_mutations_'+dof_type,
+                                       max(1, int(np.ceil(d/2))))
+            mut_numb = np.random.randint(1, min(max_mutations, d)+1, number)
+            # Random positions: the ones with the mut_numb lowest ranks.
+            ranks = np.argsort(np.argsort(np.random.rand(number, d), axis=1),
+                               axis=1)
+            rows, cols = np.nonzero((ranks < mut_numb[:, np.newaxis]) &
+                                    active[:, np.newaxis])
+            cols += start
+            dist = np.abs(values[rows, cols][:, np.newaxis]-options)
+            if periodic:
+                dist = np.minimum(dist, 360-dist)
+            banned = dist == dist.min(axis=1)[:, np.newaxis]
+            weights = getattr(self.mol, "weights_"+dof_type, None)
+            if weights is not None and len(weights) == len(options):
+                sampler = weighted_sampler(weights)
+            else:
+                sampler = None
+            new = self._draw(sampler, len(options), len(rows))
+            # Redraw banned values (up to 100 times) unless all options are
+            # banned.
+            redraw = banned[np.arange(len(rows)), new] & \
+                ~banned.all(axis=1)
+            cnt = 0
+            while redraw.any() and cnt < 100:
+                new[redraw] = self._draw(sampler, len(options), redraw.sum())
+                redraw[redraw] = banned[np.nonzero(redraw)[0], new[redraw]]
+                cnt += 1
+            keep = ~redraw
+            values[rows[keep], cols[keep]] = options[new[keep]]
+        return values
+
+    @staticmethod
+    def _draw(sampler, size, number):
+        if sampler is None:
+            return np.random.randint(0, size, number)
+        return sampler.draw(number)
+
+    def materialize(self, values, coords=None):
+        """Build a Structure object from a row of values.
+
+        Args:
+            values (numpy array): values of all degrees of freedom
+        Args(optional):
+            coords (numpy array): starting geometry, see
+            Structure.set_dof_values
+        """
+        structure = Structure(self.mol)
+        for dof, (dof_type, start, stop) in zip(structure.dof, self.layout):
+            dof.values = values[start:stop].tolist()
+            if dof_type == "pyranosering":
+                dof.values = [int(value) for value in dof.values]
+        structure.set_dof_values(coords)
+        return structure
@@ -17,6 +17,9 @@
 ''' Collection of diverse run controlling utilites '''
 from __future__ import division
 import glob
+import multiprocessing
+import os
+import shutil
 import sys
 
 from utilities import print_output, remover_file, remover_dir, backup
@@ -44,7 +47,7 @@ def simple_or_restart():
             remover_dir(d)
         remover_dir("blacklist")
         for f in ["mol.sdf", "control.in", "geometry.in", "output.txt",
-                  "result.out", "kill.dat"]:
+                  "result.out", "kill.dat", "backup_island.dat"]:
             remover_file(f)
         for f in for_restart:
             remover_file(f)
@@ -70,12 +73,16 @@ def relax_info(struct):
                      str(dof.values))
 
 
+def kill_requested():
+    """ Return True if the kill.dat file is present in the directory or in the
+    subdirectories."""
+    return len(glob.glob("*/kill.dat")) != 0 or len(glob.glob("kill.dat")) != 0
+
+
 def check_for_kill():
     """ Check if the kill.dat file is present in the directory or in the
     subdirectories. If discoveed the run will be aborted."""
-    if len(glob.glob("*/kill.dat")) == 0 and len(glob.glob("kill.dat")) == 0:
-        pass
-    else:
+    if kill_requested():
         print_output("Kill.dat file discovered. The code terminates")
         sys.exit(0)
 
@@ -108,8 +115,13 @@ def detect_energy_function(params):
 
 
 def optimize(structure, energy_function, params, name=None):
-    """Perform local optimization."""
-    if energy_function == "aims":
+    """Perform local optimization. The energy_function is either one of the
+    supported backends (see detect_energy_function) or a function that is
+    called with the structure and the name and optimizes the structure in
+    place (e.g. with perform_ff)."""
+    if callable(energy_function):
+        energy_function(structure, name)
+    elif energy_function == "aims":
         structure.perform_aims(params['sourcedir'], params['aims_call'], name)
     elif energy_function == "nwchem":
         structure.perform_nwchem(params['functional'], params['basis_set'],
@@ -130,6 +142,103 @@ def optimize(structure, energy_function, params, name=None):
         structure.perform_ff(params['force_field'], **linked_params)
 
 
+def optimize_all(structures, names, energy_function, params, processes=1):
+    """Perform local optimization of several structures.
+
+    With processes > 1 the optimizations run concurrently in a pool of
+    worker processes, see optimize_async.
+
+    Args:
+        structures (list): Structure objects, updated in place
+        names (list): names of the optimizations (e.g. storage directories)
+        energy_function (str)
+        params (dict)
+    Args(optional):
+        processes (int): number of worker processes
+    """
+    if processes == 1 or len(structures) == 1:
+        for structure, name in zip(structures, names):
+            optimize(structure, energy_function, params, name)
+        return
+    pool = multiprocessing.Pool(min(processes, len(structures)))
+    try:
+        results = [optimize_async(pool, structure, name, energy_function,
+                                  params)
+                   for structure, name in zip(structures, names)]
+        for structure, name, result in zip(structures, names, results):
+            collect_optimized(structure, name, result.get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def optimize_async(pool, structure, name, energy_function, params,
+                   callback=None):
+    """Start the local optimization of a copy of the structure in a pool of
+    worker processes and return the multiprocessing AsyncResult.
+
+    As the energy backends use fixed file names, each optimization is
+    performed in its own working directory (name+'_work'). The result has
+    to be passed to collect_optimized.
+
+    Args:
+        pool: multiprocessing.Pool
+        structure: Structure object
+        name (str): name of the optimization (e.g. storage directory)
+        energy_function (str)
+        params (dict)
+    Args(optional):
+        callback: function called with the result once it is ready
+    """
+    if 'sourcedir' in params:
+        params = dict(params)
+        params['sourcedir'] = os.path.abspath(params['sourcedir'])
+    task = (structure, energy_function, params, name)
+    return pool.apply_async(_optimize_in_dir, (task,), callback=callback)
+
+
+def collect_optimized(structure, name, result):
+    """Update the structure with the result of optimize_async. The output
+    written in the working directory is appended to the files in the
+    current directory and the working directory is removed.
+
+    Raises:
+        Exception: the exception raised during the optimization (if any)
+    """
+    workdir = name+'_work'
+    for filename in ["output.txt", "optimized_structures.sdf"]:
+        if os.path.isfile(os.path.join(workdir, filename)):
+            with open(os.path.join(workdir, filename), 'r') as inf:
+                with open(filename, 'a') as outf:
+                    outf.write(inf.read())
+    if os.path.isfile(os.path.join(workdir, "kill.dat")):
+        shutil.copy(os.path.join(workdir, "kill.dat"), "kill.dat")
+    remover_dir(workdir)
+    if isinstance(result, Exception):
+        raise result
+    del result.mol_info
+    structure.__dict__.update(result.__dict__)
+
+
+def _optimize_in_dir(task):
+    """Perform local optimization in a new working directory (worker
+    process) and return the structure, or the exception if it fails."""
+    structure, energy_function, params, name = task
+    maindir = os.getcwd()
+    workdir = name+'_work'
+    try:
+        remover_dir(workdir)
+        os.mkdir(workdir)
+        os.chdir(workdir)
+        optimize(structure, energy_function, params,
+                 os.path.join(maindir, name))
+    except Exception as exc:
+        return exc
+    finally:
+        os.chdir(maindir)
+    return structure
+
+
 def perform_backup(mol, population, blacklist, iteration, min_energy):
     """Write object representation to files for a future restart."""
     backup("backup_mol.dat", mol)
@@ -152,8 +261,10 @@ def find_linked_params(mol, params):
     return linked_params
 
 
-def check_for_convergence(iteration, params, min_energy):
-    """Check the run for convergence"""
+def is_converged(iteration, params, min_energy):
+    """Check the run for convergence. Returns True if the run is converged
+    or the maximal number of iterations is reached; the kill.dat file is
+    created in this case."""
     if iteration >= params['iter_limit_conv']-1:
         print_output("Checking for convergence")
         d = abs(min_energy[iteration+1]-min_energy[iteration + 1 -
@@ -164,7 +275,7 @@ def check_for_convergence(iteration, params, min_energy):
                 print_output("Converged")
                 killfile = open("kill.dat", "w")
                 killfile.close()
-                sys.exit(0)
+                return True
             else:
                 print_output("Not converged yet")
         else:
@@ -172,13 +283,20 @@ def check_for_convergence(iteration, params, min_energy):
                 print_output("Converged")
                 killfile = open("kill.dat", "w")
                 killfile.close()
-                sys.exit(0)
+                return True
             else:
                 print_output("Not converged yet")
     if iteration == params['max_iter']-1:
         print_output("Max. number of iterations reached. The code terminates")
         killfile = open("kill.dat", "w")
         killfile.close()
-        sys.exit(0)
+        return True
     else:
         print_output("Next iteration will be perfomed")
+        return False
+
+
+def check_for_convergence(iteration, params, min_energy):
+    """Check the run for convergence"""
+    if is_converged(iteration, params, min_energy):
+        sys.exit(0)
@@ -0,0 +1,99 @@
+#    Copyright 2015 Adriana Supady
+#
+#    This file is part of fafoom.
+#
+#   Fafoom is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Fafoom is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
+''' Weighted random sampling with cumulative tables '''
+from __future__ import division
+import numpy as np
+
+
+class WeightedSampler(object):
+    """Draw indices with probabilities proportional to a list of weights.
+
+    The weights are mapped to consecutive segments of a line; the
+    cumulative sums of the weights (the ends of the segments) are computed
+    once and a random number is located with a binary search (O(log n) per
+    draw). Segments of zero weight are never drawn.
+    """
+    def __init__(self, weights):
+        """Args:
+            weights (list): non-negative weights
+        Raises:
+            ValueError: if the list is empty, a weight is negative or all
+            weights are zero
+        """
+        self.weights = np.asarray(weights, dtype=float).ravel()
+        if len(self.weights) == 0:
+            raise ValueError("The list of weights is empty.")
+        if np.any(self.weights < 0):
+            raise ValueError("The weights need to be non-negative.")
+        self.cumulative = np.cumsum(self.weights)
+        self.total = self.cumulative[-1]
+        if self.total <= 0:
+            raise ValueError("The sum of the weights needs to be positive.")
+        self._last = int(np.flatnonzero(self.weights)[-1])
+
+    def __len__(self):
+        return len(self.weights)
+
+    def _locate(self, rn):
+        index = np.searchsorted(self.cumulative, rn, side='right')
+        return np.minimum(index, self._last)
+
+    def draw(self, size=None):
+        """Return a random index (or a numpy array of size indices drawn
+        independently)."""
+        if size is None:
+            return int(self._locate(self.total*np.random.rand()))
+        return self._locate(self.total*np.random.rand(size))
+
+    def draw_two(self):
+        """Return two different random indices. The second index is drawn
+        from the weights without the first one (with a single random number
+        instead of repeating the draw until the indices differ).
+
+        Raises:
+            ValueError: if less than two weights are positive
+        """
+        index1 = self.draw()
+        start = self.cumulative[index1-1] if index1 > 0 else 0.0
+        end = self.cumulative[index1]
+        rest = start+(self.total-end)
+        if rest <= 0:
+            raise ValueError("At least two weights need to be positive.")
+        rn = rest*np.random.rand()
+        if rn >= start:
+            # Skip the segment of the first index.
+            rn = max(rn-start+end, end)
+        return index1, int(self._locate(rn))
+
+
+_samplers = {}
+# Maximal number of cached samplers.
+MAX_CACHED_SAMPLERS = 100
+
+
+def weighted_sampler(weights):
+    """Return a WeightedSampler for the weights. The samplers are cached by
+    the values of the weights, so that e.g. a list of weights read from the
+    parameter file is converted only once."""
+    key = tuple(weights)
+    sampler = _samplers.get(key)
+    if sampler is None:
+        if len(_samplers) >= MAX_CACHED_SAMPLERS:
+            _samplers.clear()
+        sampler = WeightedSampler(weights)
+        _samplers[key] = sampler
+    return sampler
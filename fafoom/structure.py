@@ -17,11 +17,14 @@
 ''' Handle the molecule and its 3D structures.'''
 from __future__ import division
 from copy import deepcopy
+import numpy as np
 
 from get_parameters import (
     create_dof_object,
     get_atoms_and_bonds,
+    get_carried_atoms,
     get_positions,
+    get_symmetry_maps,
     template_sdf
 )
 from genetic_operations import crossover
@@ -32,12 +35,22 @@ from pyorca import OrcaObject
 
 from utilities import (
     aims2sdf,
-    check_geo_sdf,
+    bond_matrix,
+    check_geo_coords,
+    check_geo_pairs,
+    coords2sdf,
+    distance_profile,
     file2dict,
-    lowest_cartesian,
-    mirror_sdf,
+    get_clash_pairs,
+    lowest_kabsch_rms,
     print_output,
+    profile_rms_bound,
+    PROFILE_BOUND_TOLERANCE,
+    sdf2bonds,
+    sdf2coords,
     set_default,
+    SPARSE_CLASH_CHECK_ATOMS,
+    symmetry_classes,
     xyz2sdf
 
 )
@@ -74,7 +87,8 @@ class MoleculeDescription:
 
         dict_default = {'rmsd_type': "cartesian", 'distance_cutoff_1': 1.3,
                         'distance_cutoff_2': 2.15, 'rmsd_cutoff_uniq': 0.2,
-                        'chiral': True, 'optimize_torsion': True,
+                        'chiral': True, 'rmsd_heavy_atoms': False,
+                        'optimize_torsion': True,
                         'smarts_torsion':
                         "[*]~[!$(*#*)&!D1]-&!@[!$(*#*)&!D1]~[*]"}
 
@@ -91,7 +105,9 @@ class MoleculeDescription:
         repr_list = []
         for att_name in self.__dict__.keys():
 
-            if type(self.__dict__[att_name]) in [str] and \
+            if att_name.startswith('_'):
+                continue
+            elif type(self.__dict__[att_name]) in [str] and \
                att_name != "template_sdf_string":
                 repr_list.append('%s="%s"' %
                                  (att_name, getattr(self, att_name)))
@@ -112,19 +128,30 @@ class MoleculeDescription:
 
     def __eq__(self, other):
         """Compare all attribute values of two objects. Returns True if all
-        values are identical."""
+        values are identical. Private (cached) attributes are skipped."""
         for att_name in self.__dict__.keys():
+            if att_name.startswith('_'):
+                continue
             if getattr(self, att_name) == getattr(other, att_name):
                 continue
             else:
                 return False
         for att_name in other.__dict__.keys():
+            if att_name.startswith('_'):
+                continue
             if getattr(other, att_name) == getattr(self, att_name):
                 continue
             else:
                 return False
         return True
 
+    def __getstate__(self):
+        """Return the attributes to be pickled (e.g. when structures are sent
+        to worker processes). The private caches are left out; they are
+        rebuilt on demand."""
+        return dict((att_name, value) for att_name, value in
+                    self.__dict__.items() if not att_name.startswith('_'))
+
     def get_parameters(self):
         """Assign permanent attributes (number of atoms, number of bonds and
         degrees of freedom related attributes) to the object."""
@@ -146,6 +173,19 @@ class MoleculeDescription:
                     print_output("The degree to optimize: "+str(type_of_dof) +
                                  " hasn't been found.")
         setattr(self, "dof_names", dof_names)
+        self._carried_atoms = {}
+        for type_of_dof in dof_names:
+            self.get_carried_atoms(type_of_dof)
+
+    def get_carried_atoms(self, type_of_dof):
+        """Return the moving-fragment atom indices for all positions of the
+        degree of freedom. They are computed once per molecule and cached."""
+        if getattr(self, '_carried_atoms', None) is None:
+            self._carried_atoms = {}
+        if type_of_dof not in self._carried_atoms:
+            self._carried_atoms[type_of_dof] = get_carried_atoms(
+                type_of_dof, self.smiles, getattr(self, type_of_dof))
+        return self._carried_atoms[type_of_dof]
 
     def create_template_sdf(self):
         """Assign new attribute (template_sdf_string) to the object."""
@@ -153,9 +193,77 @@ class MoleculeDescription:
                                                 self.distance_cutoff_1,
                                                 self.distance_cutoff_2)
 
-
-class Structure:
-    """Create 3D structures."""
+    def get_template_coords(self):
+        """Return a copy of the coordinates of the template sdf string. The
+        coordinates are extracted once and cached."""
+        if getattr(self, '_template_coords', None) is None:
+            self._template_coords = sdf2coords(self.template_sdf_string)
+        return np.copy(self._template_coords)
+
+    def get_bonds(self):
+        """Return the bonds as an array of zero-based atom index pairs. It is
+        built once from the template sdf string and cached."""
+        if getattr(self, '_bonds', None) is None:
+            self._bonds = sdf2bonds(self.template_sdf_string)
+        return self._bonds
+
+    def get_bond_matrix(self):
+        """Return the boolean adjacency matrix of the bonded atom pairs. It
+        is built once from the bonds and cached."""
+        if getattr(self, '_bond_matrix', None) is None:
+            self._bond_matrix = bond_matrix(self.get_bonds(), self.atoms)
+        return self._bond_matrix
+
+    def get_symmetry_maps(self):
+        """Return the symmetry-equivalent atom mappings used for the
+        Cartesian RMSD (heavy atoms only if rmsd_heavy_atoms is True), see
+        get_parameters.get_symmetry_maps. They are the same for all
+        structures and are computed once and cached."""
+        if getattr(self, '_symmetry_maps', None) is None:
+            self._symmetry_maps = get_symmetry_maps(self.smiles,
+                                                    self.rmsd_heavy_atoms)
+        return self._symmetry_maps
+
+    def get_symmetry_classes(self):
+        """Return the symmetry class of each atom used for the Cartesian
+        RMSD, see utilities.symmetry_classes. It is computed once and
+        cached."""
+        if getattr(self, '_symmetry_classes', None) is None:
+            self._symmetry_classes = symmetry_classes(
+                self.get_symmetry_maps())
+        return self._symmetry_classes
+
+    def get_clash_pairs(self):
+        """Return the non-bonded atom pairs that need to be checked before
+        the degrees of freedom are set (rigid part) and after each rigid
+        fragment rotation, see utilities.get_clash_pairs. If a degree of
+        freedom deforms the molecule non-rigidly (pyranosering) or the
+        molecule has SPARSE_CLASH_CHECK_ATOMS atoms or more (the pair lists
+        grow quadratically with the number of atoms), None is returned for
+        both and the geometry is checked once at the end with
+        utilities.check_geo_coords (KD-tree based for large molecules). The
+        result is computed once and cached."""
+        if getattr(self, '_clash_pairs', None) is None:
+            if "pyranosering" in self.dof_names or \
+               self.atoms >= SPARSE_CLASH_CHECK_ATOMS:
+                self._clash_pairs = (None, None)
+            else:
+                fragments = []
+                for type_of_dof in self.dof_names:
+                    fragments.extend(self.get_carried_atoms(type_of_dof))
+                self._clash_pairs = get_clash_pairs(fragments,
+                                                    self.get_bond_matrix())
+        return self._clash_pairs
+
+
+class Structure(object):
+    """Create 3D structures.
+
+    The geometry is stored as an (atoms, 3) numpy array of Cartesian
+    coordinates; the topology is shared with the MoleculeDescription object.
+    The sdf strings are only built from the coordinates when requested (e.g.
+    by the energy backends or the backup) and are cached until the
+    coordinates change."""
     index = 0
     newline = "NEWLINE"
 
@@ -209,6 +317,81 @@ class Structure:
                 else:
                     setattr(self, str(key), kwargs[key])
 
+    @property
+    def coords(self):
+        """Cartesian coordinates of the structure, (atoms, 3) numpy array."""
+        return self._coords
+
+    @coords.setter
+    def coords(self, coords):
+        self._coords = np.array(coords, dtype=float)
+        self._sdf_string = None
+        self._geometry_valid = None
+        self._distance_profile = None
+
+    @property
+    def initial_coords(self):
+        """Cartesian coordinates before the local optimization."""
+        return self._initial_coords
+
+    @initial_coords.setter
+    def initial_coords(self, coords):
+        self._initial_coords = np.array(coords, dtype=float)
+        self._initial_sdf_string = None
+        self._initial_distance_profile = None
+
+    @initial_coords.deleter
+    def initial_coords(self):
+        del self._initial_coords
+        self._initial_sdf_string = None
+        self._initial_distance_profile = None
+
+    @property
+    def sdf_string(self):
+        """Sdf string of the structure, built from the coordinates."""
+        if getattr(self, '_sdf_string', None) is None:
+            self._sdf_string = coords2sdf(self.coords,
+                                          self.mol_info.template_sdf_string)
+        return self._sdf_string
+
+    @sdf_string.setter
+    def sdf_string(self, sdf_string):
+        self.coords = sdf2coords(sdf_string)
+        self._sdf_string = sdf_string
+
+    @property
+    def initial_sdf_string(self):
+        """Sdf string of the structure before the local optimization."""
+        if getattr(self, '_initial_sdf_string', None) is None:
+            self._initial_sdf_string = coords2sdf(
+                self.initial_coords, self.mol_info.template_sdf_string)
+        return self._initial_sdf_string
+
+    @initial_sdf_string.setter
+    def initial_sdf_string(self, sdf_string):
+        self.initial_coords = sdf2coords(sdf_string)
+        self._initial_sdf_string = sdf_string
+
+    @initial_sdf_string.deleter
+    def initial_sdf_string(self):
+        del self.initial_coords
+
+    def get_distance_profile(self, initial=False):
+        """Return the distances of the atoms (compared in the Cartesian RMSD)
+        to the centroid, sorted within the symmetry classes, for the current
+        (or the initial) geometry. They are cached until the coordinates
+        change, see utilities.distance_profile."""
+        classes = self.mol_info.get_symmetry_classes()
+        if initial:
+            if getattr(self, '_initial_distance_profile', None) is None:
+                self._initial_distance_profile = distance_profile(
+                    self.initial_coords[:len(classes)], classes)
+            return self._initial_distance_profile
+        if getattr(self, '_distance_profile', None) is None:
+            self._distance_profile = distance_profile(
+                self.coords[:len(classes)], classes)
+        return self._distance_profile
+
     def __repr__(self):
         """Create an unambiguous object representation. The resulting string
         is an one-liner with the newline parameter replacing the original
@@ -216,11 +399,14 @@ class Structure:
         repr_list = []
         for att_name in self.__dict__.keys():
 
-            if att_name in ["sdf_string", "initial_sdf_string"]:
+            if att_name in ["_coords", "_initial_coords"]:
+                sdf_name = att_name[1:].replace("coords", "sdf_string")
                 repr_list.append("%s='%s'" % (
-                    att_name, getattr(
-                        self, att_name).replace("\n",
+                    sdf_name, getattr(
+                        self, sdf_name).replace("\n",
                                                 Structure.newline)))
+            elif att_name.startswith('_'):
+                pass
             else:
                 if type(self.__dict__[att_name]) in [str]:
                     repr_list.append('%s=%s' % (
@@ -259,25 +445,98 @@ class Structure:
         structure will be generated (weights, associated with the degrees of
         freedom, will be taken into account)."""
 
-        new_string = deepcopy(self.mol_info.template_sdf_string)
         for dof in self.dof:
             if dof.type in values.keys():
-                new_string = dof.apply_on_string(new_string, values[dof.type])
+                dof.values = values[dof.type]
             else:
                 if hasattr(self.mol_info, "weights_"+str(dof.type)):
                     weights = getattr(self.mol_info, "weights_"+str(dof.type))
                     dof.get_weighted_values(weights)
                 else:
                     dof.get_random_values()
-                new_string = dof.apply_on_string(new_string)
-        self.sdf_string = new_string
+        self.set_dof_values()
+
+    def set_dof_values(self, coords=None):
+        """Build the geometry from the current values of the degrees of
+        freedom and check it for clashes on the way (see apply_dof_values).
+        If a clash is found, the coordinates are left unchanged and the
+        structure is marked as invalid, i.e. is_geometry_valid returns False.
+
+        Args(optional):
+            coords (numpy array): starting geometry, if not passed, the
+            template geometry is used
+        """
+        new_coords = self.apply_dof_values(coords, check=True)
+        if new_coords is None:
+            self._geometry_valid = False
+            return
+        self.coords = new_coords
+        self._geometry_valid = True
         for dof in self.dof:
-            dof.update_values(self.sdf_string)
+            dof.update_values_from_coords(self.coords)
+
+    def apply_dof_values(self, coords=None, check=False):
+        """Set the current values of all degrees of freedom in a single pass
+        by rotating the precomputed moving fragments of the molecule.
+
+        With check=True the geometry is validated incrementally: the pairs of
+        atoms that are not separated by any rotation are checked on the
+        starting geometry and after each rotation only the moving-static
+        pairs whose distances are final are checked. The remaining rotations
+        are skipped as soon as a clash is found. For non-rigid degrees of
+        freedom (pyranosering) and large molecules (see get_clash_pairs) the
+        full check is done at the end.
+
+        Args(optional):
+            coords (numpy array): starting geometry, if not passed, the
+            template geometry is used
+            check (bool): validate the geometry
+        Returns:
+            new coordinates (numpy array) or None if check=True and the
+            geometry is invalid
+        """
+        if coords is None:
+            coords = self.mol_info.get_template_coords()
+        cutoff1 = self.mol_info.distance_cutoff_1
+        cutoff2 = self.mol_info.distance_cutoff_2
+        rigid_pairs, move_pairs = None, None
+        if check:
+            rigid_pairs, move_pairs = self.mol_info.get_clash_pairs()
+        if move_pairs is None:
+            for dof in self.dof:
+                coords = dof.apply_on_coords(
+                    coords, self.mol_info.get_carried_atoms(dof.type))
+            if check and not check_geo_coords(
+                    coords, self.mol_info.get_bonds(), cutoff1, cutoff2,
+                    bonded=self.mol_info.get_bond_matrix()):
+                return None
+            return coords
+        # Bond lengths are not changed by the rotations.
+        if not (check_geo_pairs(coords, self.mol_info.get_bonds(),
+                                cutoff2=cutoff2) and
+                check_geo_pairs(coords, rigid_pairs, cutoff1=cutoff1)):
+            return None
+        start = 0
+        for dof in self.dof:
+            pairs = move_pairs[start:start+len(dof.positions)]
+            start += len(dof.positions)
+            coords = dof.apply_on_coords(
+                coords, self.mol_info.get_carried_atoms(dof.type),
+                check=lambda new, i: check_geo_pairs(new, pairs[i],
+                                                     cutoff1=cutoff1))
+            if coords is None:
+                return None
+        return coords
 
     def is_geometry_valid(self):
-        """Return True if the geometry is valid."""
-        check = check_geo_sdf(self.sdf_string, self.mol_info.distance_cutoff_1,
-                              self.mol_info.distance_cutoff_2)
+        """Return True if the geometry is valid. The result of the check done
+        while the degrees of freedom were set is reused."""
+        if getattr(self, '_geometry_valid', None) is not None:
+            return self._geometry_valid
+        check = check_geo_coords(self.coords, self.mol_info.get_bonds(),
+                                 self.mol_info.distance_cutoff_1,
+                                 self.mol_info.distance_cutoff_2,
+                                 bonded=self.mol_info.get_bond_matrix())
         return check
 
     def __eq__(self, other):
@@ -303,21 +562,24 @@ class Structure:
             raise Exception("Both structures are already relaxed.")
 
         if obj1.mol_info.rmsd_type == 'cartesian':
-            linked_strings = {}
-
-            if hasattr(obj2, "initial_sdf_string"):
-                n_str = str(obj2.initial_sdf_string)
-                linked_strings[n_str] = obj2.initial_sdf_string
-
-            if not obj1.mol_info.chiral:
-                n_str = str(mirror_sdf(obj2.sdf_string))
-                linked_strings[n_str] = mirror_sdf(obj2.sdf_string)
-                if hasattr(obj2, "initial_sdf_string"):
-                    n_str = str(mirror_sdf(obj2.initial_sdf_string))
-                    linked_strings[n_str] = mirror_sdf(obj2.initial_sdf_string)
+            # Skip the alignment if the structures are clearly different.
+            profile = obj1.get_distance_profile()
+            bounds = [profile_rms_bound(profile,
+                                        obj2.get_distance_profile())]
+            if hasattr(obj2, "initial_coords"):
+                bounds.append(profile_rms_bound(
+                    profile, obj2.get_distance_profile(initial=True)))
+            if min(bounds) > obj1.mol_info.rmsd_cutoff_uniq + \
+                    PROFILE_BOUND_TOLERANCE:
+                return False
 
-            bestrms = lowest_cartesian(obj1.sdf_string, obj2.sdf_string,
-                                       **linked_strings)
+            maps = obj1.mol_info.get_symmetry_maps()
+            atoms = maps.shape[1]
+            other_coords = [obj2.coords[:atoms]]
+            if hasattr(obj2, "initial_coords"):
+                other_coords.append(obj2.initial_coords[:atoms])
+            bestrms = lowest_kabsch_rms(obj1.coords[:atoms], other_coords,
+                                        maps, not obj1.mol_info.chiral)
 
             if bestrms > obj1.mol_info.rmsd_cutoff_uniq:
                 return False
@@ -325,16 +587,11 @@ class Structure:
                 return True
 
         if obj1.mol_info.rmsd_type == 'internal_coord':
-            all_bool = []
             for dof1, dof2 in zip(obj1.dof, obj2.dof):
-                all_bool.append(dof1.is_equal(dof2,
-                                              obj1.mol_info.rmsd_cutoff_uniq,
-                                              obj1.mol_info.chiral))
-
-            if False in all_bool:
-                return False
-            else:
-                return True
+                if not dof1.is_equal(dof2, obj1.mol_info.rmsd_cutoff_uniq,
+                                     obj1.mol_info.chiral):
+                    return False
+            return True
 
     def __cmp__(self, other):
         """Compare two object basing on their energy values."""
@@ -362,13 +619,13 @@ class Structure:
         if success:
             aims_object.clean_and_store()
             self.energy = aims_object.get_energy()
-            self.initial_sdf_string = self.sdf_string
+            self.initial_coords = self.coords
             self.sdf_string = aims2sdf(aims_object.get_aims_string_opt(),
                                        self.mol_info.template_sdf_string)
 
             for dof in self.dof:
                 setattr(dof, "initial_values", dof.values)
-                dof.update_values(self.sdf_string)
+                dof.update_values_from_coords(self.coords)
         else:
             print_output("The FHI-aims relaxation failed")
 
@@ -381,13 +638,13 @@ class Structure:
         nwchem_object.run_nwchem(execution_string)
         nwchem_object.clean()
         self.energy = nwchem_object.get_energy()
-        self.initial_sdf_string = self.sdf_string
+        self.initial_coords = self.coords
         self.sdf_string = xyz2sdf(nwchem_object.get_xyz_string_opt(),
                                   self.mol_info.template_sdf_string)
 
         for dof in self.dof:
             setattr(dof, "initial_values", dof.values)
-            dof.update_values(self.sdf_string)
+            dof.update_values_from_coords(self.coords)
 
     def perform_orca(self, commandline, memory, execution_string, **kwargs):
         """Generate the orca input, run orca, assign new attributes and
@@ -398,13 +655,13 @@ class Structure:
         orca_object.run_orca(execution_string)
         orca_object.clean()
         self.energy = orca_object.get_energy()
-        self.initial_sdf_string = self.sdf_string
+        self.initial_coords = self.coords
         self.sdf_string = xyz2sdf(orca_object.get_xyz_string_opt(),
                                   self.mol_info.template_sdf_string)
 
         for dof in self.dof:
             setattr(dof, "initial_values", dof.values)
-            dof.update_values(self.sdf_string)
+            dof.update_values_from_coords(self.coords)
 
     def perform_ff(self, force_field, **kwargs):
         """Generate the force-field input, run force=field calculation, assign
@@ -412,12 +669,12 @@ class Structure:
         ff_object = FFObject(force_field, **kwargs)
         ff_object.run_ff(self.sdf_string)
         self.energy = ff_object.get_energy()
-        self.initial_sdf_string = self.sdf_string
+        self.initial_coords = self.coords
         self.sdf_string = ff_object.get_sdf_string_opt()
         ff_object.save_to_file()
         for dof in self.dof:
             setattr(dof, "initial_values", dof.values)
-            dof.update_values(self.sdf_string)
+            dof.update_values_from_coords(self.coords)
 
     def crossover(self, other):
         """Perform the crossover."""
@@ -436,12 +693,7 @@ class Structure:
                 setattr(dof_child2, "values", b)
 
         for child in child1, child2:
-            new_string = deepcopy(child.mol_info.template_sdf_string)
-            for dof in child.dof:
-                new_string = dof.apply_on_string(new_string, dof.values)
-            child.sdf_string = new_string
-            for dof in child.dof:
-                dof.update_values(child.sdf_string)
+            child.set_dof_values()
 
         return child1, child2
 
@@ -475,9 +727,4 @@ class Structure:
                 else:
                     call_mut(dof)
 
-        new_string = deepcopy(self.sdf_string)
-        for dof in self.dof:
-            new_string = dof.apply_on_string(new_string, dof.values)
-        self.sdf_string = new_string
-        for dof in self.dof:
-            dof.update_values(self.sdf_string)
+        self.set_dof_values(self.coords)
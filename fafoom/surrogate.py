@@ -0,0 +1,186 @@
+#    Copyright 2015 Adriana Supady
+#
+#    This file is part of fafoom.
+#
+#   Fafoom is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Lesser General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   Fafoom is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#   along with fafoom.  If not, see <http://www.gnu.org/licenses/>.
+''' Surrogate model of the energy for ranking candidates '''
+from __future__ import division
+import math
+import numpy as np
+
+from deg_of_freedom import PyranoseRing
+
+
+class Surrogate(object):
+    """Kernel ridge regression of the energy after the local optimization on
+    the values of the degrees of freedom.
+
+    Each structure is described by the sines and cosines of its dihedral
+    angles (torsions, cis/trans bonds and the ring dihedrals of the pyranose
+    ring conformations). The relaxed structures provide two samples with
+    the same energy: the values before (initial_values) and after the local
+    optimization; for non-chiral molecules the mirror images (inverted
+    angles) are added too. A Gaussian kernel with the median distance of the
+    training samples as length scale is used unless a length scale is
+    given.
+
+    The model is trained as soon as min_samples relaxed structures are
+    available (samples) on at most max_samples of them with the lowest
+    energies (size). Two errors are tracked: the leave-one-out error of
+    the training set (computed in closed form, all samples of a structure
+    are left out together) and the error of the predictions made for
+    structures that were relaxed afterwards (see record).
+    """
+    def __init__(self, regularization=1e-3, length_scale=None,
+                 min_samples=10, max_samples=500):
+        """Args(optional):
+            regularization (float): ridge parameter (relative to the kernel
+            diagonal of 1)
+            length_scale (float): length scale of the Gaussian kernel
+            min_samples (int): minimal number of structures for training
+            max_samples (int): maximal number of structures for training
+        """
+        self.regularization = regularization
+        self.length_scale = length_scale
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.predictions = []
+        self._trained = None
+        self.samples = 0
+        self.size = 0
+
+    @staticmethod
+    def dof_angles(dof_type, values):
+        """Return the dihedral angles [in deg] for the values of a degree of
+        freedom (numpy array, the last axis runs over the positions)."""
+        values = np.asarray(values)
+        if dof_type == "pyranosering":
+            angles = PyranoseRing.ring_dih_array[values.astype(int)]
+            return angles.reshape(values.shape[:-1]+(-1,))
+        return values.astype(float)
+
+    @staticmethod
+    def angles(structure, initial=False):
+        """Return the dihedral angles [in deg] describing the structure."""
+        return np.concatenate([Surrogate.dof_angles(
+            dof.type, dof.initial_values if initial else dof.values)
+            for dof in structure.dof])
+
+    @staticmethod
+    def _features(angles):
+        rad = np.radians(angles)
+        return np.concatenate((np.sin(rad), np.cos(rad)), axis=-1)
+
+    def _kernel(self, x1, x2):
+        dist = np.sum(x1*x1, axis=1)[:, np.newaxis] + \
+            np.sum(x2*x2, axis=1)-2*np.dot(x1, x2.T)
+        return np.exp(-np.maximum(dist, 0)/(2*self._scale**2))
+
+    def is_trained(self):
+        return self._trained is not None
+
+    def train(self, structures):
+        """Train the model on the relaxed structures (e.g. the blacklist).
+        The model is only rebuilt if the number of relaxed structures has
+        changed."""
+        relaxed = [structure for structure in structures
+                   if hasattr(structure, "energy") and
+                   all(hasattr(dof, "initial_values")
+                       for dof in structure.dof)]
+        if len(relaxed) < self.min_samples or len(relaxed) == self.samples:
+            return
+        self.samples = len(relaxed)
+        relaxed.sort(key=lambda structure: structure.energy)
+        relaxed = relaxed[:self.max_samples]
+        self.size = len(relaxed)
+        angles, energies = [], []
+        for structure in relaxed:
+            for initial in [True, False]:
+                angles.append(self.angles(structure, initial))
+                energies.append(structure.energy)
+        angles, energies = np.array(angles), np.array(energies)
+        if not relaxed[0].mol_info.chiral:
+            angles = np.concatenate((angles, -angles))
+            energies = np.concatenate((energies, energies))
+        x = self._features(angles)
+        if self.length_scale is not None:
+            self._scale = self.length_scale
+        else:
+            dist = np.sqrt(np.maximum(
+                np.sum(x*x, axis=1)[:, np.newaxis] + np.sum(x*x, axis=1) -
+                2*np.dot(x, x.T), 0))
+            self._scale = max(np.median(dist[np.triu_indices(len(x), 1)]),
+                              1e-3)
+        self._mean = np.mean(energies)
+        inverse = np.linalg.inv(self._kernel(x, x) +
+                                self.regularization*np.eye(len(x)))
+        self._alpha = np.dot(inverse, energies-self._mean)
+        self._x = x
+        # Leave-one-out residuals of kernel ridge regression, leaving out
+        # all samples of a structure at once: (inverse_GG)^-1 alpha_G for
+        # the samples G of each structure.
+        groups = np.arange(2*len(relaxed)).reshape(-1, 2)
+        if len(x) > len(groups)*2:
+            groups = np.hstack((groups, groups+len(groups)*2))
+        blocks = inverse[groups[:, :, np.newaxis], groups[:, np.newaxis, :]]
+        self._loo = np.array([np.linalg.solve(block, self._alpha[group])
+                              for block, group in zip(blocks, groups)])
+        self._trained = True
+
+    def predict(self, structures):
+        """Return the predicted energies of the (not relaxed) structures.
+
+        Raises:
+            ValueError: if the model hasn't been trained yet
+        """
+        return self._predict(np.array([self.angles(structure)
+                                       for structure in structures]))
+
+    def predict_values(self, values, layout):
+        """Return the predicted energies for the rows of values (see
+        Population).
+
+        Raises:
+            ValueError: if the model hasn't been trained yet
+        """
+        return self._predict(np.concatenate([
+            self.dof_angles(dof_type, values[:, start:stop])
+            for dof_type, start, stop in layout], axis=1))
+
+    def _predict(self, angles):
+        if not self.is_trained():
+            raise ValueError("The model hasn't been trained yet.")
+        x = self._features(angles)
+        return self._mean+np.dot(self._kernel(x, self._x), self._alpha)
+
+    def record(self, predicted, energy):
+        """Record a prediction together with the energy obtained afterwards
+        by the local optimization."""
+        self.predictions.append((predicted, energy))
+
+    def loo_error(self):
+        """Return the leave-one-out RMS error of the training set, leaving
+        out all samples of a structure together (None if the model hasn't
+        been trained yet)."""
+        if not self.is_trained():
+            return None
+        return math.sqrt(np.mean(self._loo**2))
+
+    def prediction_error(self):
+        """Return the RMS error of the recorded predictions (None if none
+        have been recorded)."""
+        if not self.predictions:
+            return None
+        diff = np.array([p-e for p, e in self.predictions])
+        return math.sqrt(np.mean(diff**2))
@@ -27,6 +27,27 @@ from rdkit.Chem import AllChem
 
 from operator import itemgetter
 
+from sampler import WeightedSampler
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Number of alignments (geometries times atom mappings) done at once in
+# kabsch_rms_batch.
+KABSCH_CHUNK = 4096
+
+# Tolerance for the comparison of the RMS lower bounds with the cutoff.
+PROFILE_BOUND_TOLERANCE = 1e-3
+
+# Number of atoms from which on the clash check switches from the dense
+# distance matrix to a KD-tree query (only if scipy is available). From this
+# size on, Structure.set_dof_values also skips the incremental check with
+# precomputed pair lists and calls check_geo_coords once at the end (see
+# MoleculeDescription.get_clash_pairs).
+SPARSE_CLASH_CHECK_ATOMS = 60
+
 # Flow-handling
 
 
@@ -144,6 +165,37 @@ def cleaner(list_to_clean):
     return clean_list
 
 
+def find_carried_atoms(neighbors, at1, at2, cut_bonds=None):
+    """Find all atoms that move together with atom at2 if the bond at1-at2 is
+    rotated, i.e. the atoms connected to at2 without passing through at1.
+
+    Args(required):
+        neighbors (list): list of the neighbor indices of each atom
+        at1, at2 (int): atoms defining the bond
+    Args(optional):
+        cut_bonds (list): further bonds (pairs of atoms) to be ignored
+    Returns:
+        sorted numpy array of atom indices (including at2)
+    Raises:
+        ValueError: if the bond is part of a ring
+    """
+    cut = set([(at1, at2), (at2, at1)])
+    if cut_bonds is not None:
+        for a, b in cut_bonds:
+            cut.update([(a, b), (b, a)])
+    carried = set([at2])
+    to_visit = [at2]
+    while to_visit:
+        at = to_visit.pop()
+        for x in neighbors[at]:
+            if x not in carried and (at, x) not in cut:
+                carried.add(x)
+                to_visit.append(x)
+    if at1 in carried:
+        raise ValueError("The bond is part of a ring")
+    return np.array(sorted(carried), dtype=int)
+
+
 def get_vec(vec1, vec2):
     """Calculate difference between vectors of angles [in rad!].
     Args:
@@ -161,20 +213,50 @@ def get_vec(vec1, vec2):
     """
     if len(vec1) != len(vec2):
         raise ValueError("No length match between the lists")
-    diff_vec = np.zeros(len(vec1))
-    for i in range(0, len(vec1)):
-        tor_diff = abs(vec1[i]-vec2[i])
-        diff_vec[i] = min(abs(tor_diff), abs(360-tor_diff))/180.0
-    return diff_vec
+    tor_diff = np.abs(np.asarray(vec1, dtype=float) -
+                      np.asarray(vec2, dtype=float))
+    return np.minimum(tor_diff, np.abs(360-tor_diff))/180.0
 
 
 def tor_rmsd(p, vec):
     """Calculate the modified p norm.The difference from standard norm is the
     fact that the addends are divided by the length of the vector."""
-    summe = 0
-    for i in range(0, len(vec)):
-        summe += math.pow(abs(vec[i]), p)
-    return math.pow(summe/len(vec), (1.0/p))
+    return float(np.mean(np.abs(vec)**p)**(1.0/p))
+
+
+def lowest_tor_rmsd(vec, others, mirror=False, p=2):
+    """Return the lowest torsional RMSD (see get_vec and tor_rmsd) between
+    the angles and each row of stored angles. The angles are expected in the
+    range [-180, 180].
+
+    Args:
+        vec (list): n angles in deg
+        others (numpy array): stored angles in deg of shape (N, n) or, if
+        several variants (e.g. values and initial values) are stored per
+        row, (N, variants, n)
+    Args(optional):
+        mirror (bool): if True, the inverted stored angles (mirror images)
+        are considered too
+        p (int): the order of the norm
+    Returns:
+        numpy array of shape (N,) with the lowest value over the variants
+    Raises:
+        ValueError: if the number of angles differ
+    """
+    vec = np.asarray(vec, dtype=float)
+    others = np.asarray(others, dtype=float)
+    size = len(vec)
+    if others.shape[-1] != size:
+        raise ValueError("No length match between the lists")
+    others = others.reshape(len(others), -1, 1, size)
+    if mirror:
+        # Comparing with the inverted stored angles is the same as comparing
+        # the inverted angles with the stored ones.
+        vec = np.array([vec, -vec])
+    tor_diff = np.abs(others-vec)
+    tor_diff = np.minimum(tor_diff, 360-tor_diff)
+    summe = (tor_diff**p).sum(axis=-1).reshape(len(others), -1)
+    return (summe.min(axis=1)/size)**(1.0/p)/180.0
 
 
 def get_cartesian_rms(sdf_string1, sdf_string2):
@@ -189,7 +271,6 @@ def lowest_cartesian(string1, string2, **linked_strings):
     """Select lowest Cartesian RMS for two structures (for nonchiral and
     previously optimized structures)."""
     values = []
-    get_cartesian_rms(string1, string2)
     values.append(get_cartesian_rms(string1, string2))
     if linked_strings:
         for string in linked_strings:
@@ -198,47 +279,157 @@ def lowest_cartesian(string1, string2, **linked_strings):
     return min(values)
 
 
+def lowest_kabsch_rms(coords, other_coords, maps, mirror=False):
+    """Select the lowest Cartesian RMS between a geometry and a list of
+    geometries after the optimal superposition (Kabsch), for all the given
+    atom mappings.
+
+    Args(required):
+        coords (numpy array): Cartesian coordinates, shape (atoms, 3)
+        other_coords (list): numpy arrays of the same shape
+        maps (numpy array): atom mappings, shape (mappings, atoms), see
+        get_parameters.get_symmetry_maps
+    Args(optional):
+        mirror (bool): if True, the mirror images of the other geometries are
+        considered too
+    Returns:
+        RMS (float)
+    """
+    return float(np.min(kabsch_rms_batch(coords, np.array(other_coords), maps,
+                                         mirror)))
+
+
+def kabsch_rms_batch(coords, other_coords, maps, mirror=False):
+    """Calculate the Cartesian RMS between a geometry and each of a stack of
+    geometries after the optimal superposition (Kabsch), minimized over all
+    the given atom mappings.
+
+    Args(required):
+        coords (numpy array): Cartesian coordinates, shape (atoms, 3)
+        other_coords (numpy array): shape (geometries, atoms, 3)
+        maps (numpy array): atom mappings, shape (mappings, atoms), see
+        get_parameters.get_symmetry_maps
+    Args(optional):
+        mirror (bool): if True, the mirror images of the other geometries are
+        considered too
+    Returns:
+        numpy array of shape (geometries,)
+    """
+    ref = coords-np.mean(coords, axis=0)
+    probes = other_coords-np.mean(other_coords, axis=1)[:, None, :]
+    norms = np.sum(ref*ref)+np.sum(probes*probes, axis=(1, 2))
+    # Gathered coordinates per axis, shape (geometries, 3, atoms).
+    probes_t = np.ascontiguousarray(np.transpose(probes, (0, 2, 1)))
+    rows = max(1, KABSCH_CHUNK//len(maps))
+    best = np.empty(len(probes))
+    for first in range(0, len(probes), rows):
+        block = probes_t[first:first+rows]
+        for start in range(0, len(maps), KABSCH_CHUNK):
+            # Covariance matrices, shape (geometries, mappings, 3, 3).
+            cov = np.dot(block[:, :, maps[start:start+KABSCH_CHUNK]], ref)
+            cov = np.transpose(cov, (0, 2, 1, 3))
+            flat = cov.reshape(-1, 3, 3)
+            sing = _singular_values_3x3(flat)
+            # A reflection is allowed for the mirror images.
+            if mirror:
+                sign = 1.0
+            else:
+                sign = np.sign(_det_3x3(flat))
+            dev = (sing[:, 0]+sing[:, 1]+sign*sing[:, 2]).reshape(
+                cov.shape[:2])
+            dev = norms[first:first+rows]-2.0*np.max(dev, axis=1)
+            if start == 0:
+                best[first:first+rows] = dev
+            else:
+                best[first:first+rows] = np.minimum(
+                    best[first:first+rows], dev)
+    return np.sqrt(np.maximum(best, 0.0)/len(ref))
+
+
+def _det_3x3(mat):
+    """Determinants of a stack of 3x3 matrices."""
+    return (mat[:, 0, 0]*(mat[:, 1, 1]*mat[:, 2, 2] -
+                          mat[:, 1, 2]*mat[:, 2, 1]) -
+            mat[:, 0, 1]*(mat[:, 1, 0]*mat[:, 2, 2] -
+                          mat[:, 1, 2]*mat[:, 2, 0]) +
+            mat[:, 0, 2]*(mat[:, 1, 0]*mat[:, 2, 1] -
+                          mat[:, 1, 1]*mat[:, 2, 0]))
+
+
+def _singular_values_3x3(mat):
+    """Singular values (descending) of a stack of 3x3 matrices, from the
+    closed-form eigenvalues of the symmetric matrices mat^T mat."""
+    sym = np.einsum('kab,kac->kbc', mat, mat)
+    q = np.trace(sym, axis1=1, axis2=2)/3.0
+    off = sym[:, 0, 1]**2+sym[:, 0, 2]**2+sym[:, 1, 2]**2
+    diag = sym[:, [0, 1, 2], [0, 1, 2]]-q[:, None]
+    p = np.sqrt((np.sum(diag*diag, axis=1)+2.0*off)/6.0)
+    scale = np.where(p > 0, p, 1.0)
+    shifted = sym/scale[:, None, None]
+    shifted[:, [0, 1, 2], [0, 1, 2]] = diag/scale[:, None]
+    phi = np.arccos(np.clip(_det_3x3(shifted)/2.0, -1.0, 1.0))/3.0
+    eig1 = q+2.0*p*np.cos(phi)
+    eig3 = q+2.0*p*np.cos(phi+2.0*math.pi/3.0)
+    eig2 = 3.0*q-eig1-eig3
+    return np.sqrt(np.maximum(np.column_stack((eig1, eig2, eig3)), 0.0))
+
+
+def symmetry_classes(maps):
+    """Return a class label for each atom; atoms that are mapped onto each
+    other by any of the atom mappings share the same label."""
+    labels = np.arange(maps.shape[1])
+    while True:
+        new_labels = np.minimum(labels, np.min(labels[maps], axis=0))
+        np.minimum.at(new_labels, maps.ravel(),
+                      np.tile(new_labels, len(maps)))
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def distance_profile(coords, classes=None):
+    """Return the sorted distances of the atoms to the centroid. The profile
+    does not change under rotation, translation and reflection and under
+    permutations of the atoms within the same class.
+
+    Args(required):
+        coords (numpy array): Cartesian coordinates, shape (atoms, 3)
+    Args(optional):
+        classes (numpy array): class of each atom (e.g. symmetry classes); if
+        passed, the distances are sorted within the classes only
+    Returns:
+        numpy array
+    """
+    centered = coords-np.mean(coords, axis=0)
+    dist = np.sqrt(np.sum(centered*centered, axis=1))
+    if classes is None:
+        return np.sort(dist)
+    return dist[np.lexsort((dist, classes))]
+
+
+def profile_rms_bound(profile1, profile2):
+    """Return a lower bound for the Cartesian RMS of two structures (after
+    the optimal superposition and for any atom mapping that respects the
+    classes) from their distance profiles, see distance_profile. The bound
+    is checked against cutoffs with PROFILE_BOUND_TOLERANCE to allow for
+    rounding differences."""
+    diff = profile1-profile2
+    return math.sqrt(np.mean(diff*diff))
+
+
 def find_one_in_list(sum_array, list_to_search):
     """Generate a random number and return the corresponding index from a
     list. See the description of the method find_two_in_list."""
-    nparray_to_search = np.array(list_to_search)
-    rn = sum_array*np.random.rand()
-    found = False
-    index = 0
-    while not found:
-        if rn <= nparray_to_search[:index+1].sum(axis=0):
-            found = True
-        else:
-            index += 1
-    return index
+    return WeightedSampler(list_to_search).draw()
 
 
 def find_two_in_list(list_sum, nparray_to_search):
     """A numpy array is mapped to a segment of a line which length is equal to
     1. The lengths of the segments are proportional to the corresponding numpy
     array values. Next, two random numbers between 0 and 1 are generated and
-    the segments containing these random numbers are returned."""
-    rn1 = list_sum*np.random.rand()
-    found1 = False
-    index1 = 0
-    while not found1:
-        if rn1 < nparray_to_search[:index1+1].sum(axis=0):
-            found1 = True
-        else:
-            index1 += 1
-    equal = True
-    while equal:
-        rn2 = list_sum*np.random.rand()
-        found2 = False
-        index2 = 0
-        while not found2:
-            if rn2 < nparray_to_search[:index2+1].sum(axis=0):
-                found2 = True
-            else:
-                index2 += 1
-        if index2 != index1:
-            equal = False
-    return index1, index2
+    the segments containing these random numbers are returned (the segments
+    are different). See sampler.WeightedSampler."""
+    return WeightedSampler(nparray_to_search).draw_two()
 
 
 def find_closest(numb, list_of_values, periodic=False):
@@ -274,54 +465,143 @@ def check_geo_sdf(sdf_string, cutoff1, cutoff2):
     Raises:
         ValueError: if distance cutoffs are non-positive
     """
+    return check_geo_coords(sdf2coords(sdf_string), sdf2bonds(sdf_string),
+                            cutoff1, cutoff2)
 
+
+def check_geo_coords(coords, bonds, cutoff1, cutoff2, bonded=None):
+    """Check geometry for clashes.
+
+    Bond lengths are checked on the bond list. For the non-bonded pairs the
+    full distance matrix is used for small molecules; from
+    SPARSE_CLASH_CHECK_ATOMS atoms on only the pairs closer than
+    distance_cutoff_1 are looked up with a KD-tree (requires scipy). This is
+    the check used when the geometry of a large molecule is built from the
+    values of the degrees of freedom.
+
+    Args:
+        coords (numpy array): Cartesian coordinates, shape (atoms, 3)
+        bonds (numpy array): zero-based atom indices, shape (bonds, 2)
+        distance_cutoff_1 (float): min distance between non-bonded atoms [A]
+        distance_cutoff_2 (float): max distance between bonded atoms [A]
+    Args(optional):
+        bonded (numpy array): boolean adjacency matrix, shape (atoms, atoms);
+        built from the bonds if needed and not provided
+    Returns:
+        True for clash-free geometries and False for invalid geometries
+    Raises:
+        ValueError: if distance cutoffs are non-positive
+    """
     if cutoff1 <= 0 or cutoff2 <= 0:
         raise ValueError("Distance cutoff needs to be a positive float")
-    atoms, bonds = get_ind_from_sdfline(sdf_string.split('\n')[3])
-    coordinates = np.zeros((atoms, 3))
-    bonds_list = []
-    for i in range(4, atoms+4):
-        coordinates[i-4][0:3] = sdf_string.split('\n')[i].split()[0:3]
-    for i in range(atoms+4, atoms+bonds+4):
-        e1, e2 = get_ind_from_sdfline(sdf_string.split('\n')[i])
-        bonds_list.append([e1, e2])
-    dist = np.zeros((atoms, atoms))
-    for x in range(atoms):
-        for y in range(x, atoms):
-            dist[x][y] = distance(np.array(coordinates[x]),
-                                  np.array(coordinates[y]))
-            dist[y][x] = dist[x][y]
-    check = True
-    for x in range(atoms):
-        for y in range(x+1, atoms):
-            if [x+1, y+1] not in bonds_list and [y+1, x+1] not in bonds_list:
-                if dist[x][y] < cutoff1:
-                    check = False
-                    return check
-            else:
-                if dist[x][y] > cutoff2:
-                    check = False
-                    return check
-    return check
+    if not check_geo_pairs(coords, bonds, cutoff2=cutoff2):
+        return False
+    atoms = len(coords)
+    if cKDTree is not None and atoms >= SPARSE_CLASH_CHECK_ATOMS:
+        return _check_nonbonded_sparse(coords, bonds, cutoff1)
+    if bonded is None:
+        bonded = bond_matrix(bonds, atoms)
+    diff = coords[:, np.newaxis, :]-coords[np.newaxis, :, :]
+    dist2 = np.sum(diff*diff, axis=-1)
+    np.fill_diagonal(dist2, np.inf)
+    return not np.any(dist2[~bonded] < cutoff1**2)
+
+
+def check_geo_pairs(coords, pairs, cutoff1=None, cutoff2=None):
+    """Check the distances of the given atom pairs only.
+
+    Args:
+        coords (numpy array): Cartesian coordinates, shape (atoms, 3)
+        pairs (numpy array): zero-based atom indices, shape (pairs, 2)
+    Args(optional):
+        cutoff1 (float): min allowed distance [A]
+        cutoff2 (float): max allowed distance [A]
+    Returns:
+        True if all distances lie within the cutoffs
+    """
+    if len(pairs) == 0:
+        return True
+    diff = coords[pairs[:, 0]]-coords[pairs[:, 1]]
+    dist2 = np.sum(diff*diff, axis=1)
+    if cutoff1 is not None and np.any(dist2 < cutoff1**2):
+        return False
+    if cutoff2 is not None and np.any(dist2 > cutoff2**2):
+        return False
+    return True
+
+
+def get_clash_pairs(fragments, bonded):
+    """Distribute the non-bonded atom pairs among the rigid rotations of
+    molecular fragments that are applied one after another.
+
+    The distance of a pair changes only if one atom moves with a fragment and
+    the other does not. After the last such rotation the distance is final,
+    so the pair needs to be checked only at this point.
+
+    Args:
+        fragments (list): numpy arrays with the indices of the moving atoms,
+        in order of application
+        bonded (numpy array): boolean adjacency matrix, shape (atoms, atoms)
+    Returns:
+        pairs that are never separated (numpy array, shape (pairs, 2)) and a
+        list with the pairs finalized by each rotation
+    """
+    atoms = len(bonded)
+    last = np.empty((atoms, atoms), dtype=int)
+    last.fill(-1)
+    moving = np.zeros(atoms, dtype=bool)
+    for ind, carried in enumerate(fragments):
+        moving[:] = False
+        moving[carried] = True
+        last[moving[:, np.newaxis] != moving[np.newaxis, :]] = ind
+    candidates = np.triu(~bonded, 1)
+    pairs = [np.transpose(np.nonzero(candidates & (last == ind)))
+             for ind in range(-1, len(fragments))]
+    return pairs[0], pairs[1:]
+
+
+def _check_nonbonded_sparse(coords, bonds, cutoff1):
+    """Return True if no non-bonded pair is closer than cutoff1, testing
+    only the pairs found by a KD-tree query."""
+    pairs = cKDTree(coords).query_pairs(cutoff1, output_type='ndarray')
+    if len(pairs) == 0:
+        return True
+    diff = coords[pairs[:, 0]]-coords[pairs[:, 1]]
+    close = pairs[np.sum(diff*diff, axis=1) < cutoff1**2]
+    if len(close) == 0:
+        return True
+    atoms = len(coords)
+    close_keys = close.min(axis=1)*atoms+close.max(axis=1)
+    bond_keys = bonds.min(axis=1)*atoms+bonds.max(axis=1)
+    return bool(np.all(np.isin(close_keys, bond_keys)))
+
+
+def sdf2bonds(sdf_string):
+    """Extract the bonds from a sdf string.
+
+    Returns:
+        numpy array of shape (number of bonds, 2) with zero-based atom indices
+    """
+    sdf_form = sdf_string.split('\n')
+    atoms, bonds = get_ind_from_sdfline(sdf_form[3])
+    bonds_list = [get_ind_from_sdfline(sdf_form[i])
+                  for i in range(atoms+4, atoms+bonds+4)]
+    return np.array(bonds_list, dtype=int).reshape(-1, 2)-1
+
+
+def bond_matrix(bonds, atoms):
+    """Build the symmetric boolean adjacency matrix from a bond array."""
+    bonded = np.zeros((atoms, atoms), dtype=bool)
+    bonded[bonds[:, 0], bonds[:, 1]] = True
+    bonded[bonds[:, 1], bonds[:, 0]] = True
+    return bonded
 
 
 def get_ind_from_sdfline(sdf_line):
     """Extract the indicies from the sdf string (for molecules with more than
-    99 atoms)"""
-    l = len(sdf_line.split()[0])
-    if l < 4:
-        ind1 = int(sdf_line.split()[0])
-        ind2 = int(sdf_line.split()[1])
-    else:
-        list_ind = list(sdf_line.split()[0])
-        if len(list_ind) == 5:
-            ind1 = int(list_ind[0]+list_ind[1])
-            ind2 = int(list_ind[2]+list_ind[3]+list_ind[4])
-        if len(list_ind) == 6:
-            ind1 = int(list_ind[0]+list_ind[1]+list_ind[2])
-            ind2 = int(list_ind[3]+list_ind[4]+list_ind[5])
-
-    return ind1, ind2
+    99 atoms). The first two fields of the counts and bond lines are three
+    characters wide and can run into each other (e.g. '  9100')."""
+    return int(sdf_line[0:3]), int(sdf_line[3:6])
 
 # Format conversions
 
@@ -450,3 +730,30 @@ def mirror_sdf(sdf_string):
             c.append(''.join(sdf_form[i])+'\n')
     mirror_sdf_string = ''.join(c)
     return mirror_sdf_string
+
+
+def sdf2coords(sdf_string):
+    """Extract the Cartesian coordinates from a sdf string.
+
+    Returns:
+        numpy array of shape (number of atoms, 3)
+    """
+    sdf_form = sdf_string.split('\n')
+    atoms = get_ind_from_sdfline(sdf_form[3])[0]
+    coords = np.zeros((atoms, 3))
+    for i in range(atoms):
+        coords[i] = sdf_form[4+i].split()[0:3]
+    return coords
+
+
+def coords2sdf(coords, sdf_template_string):
+    """Convert Cartesian coordinates to a sdf string. Template for the sdf
+    string is required; only the coordinate columns of the atom block are
+    replaced."""
+    sdf_form = sdf_template_string.split('\n')
+    for i in range(len(coords)):
+        sdf_form[4+i] = '%10.4f%10.4f%10.4f%s' % (coords[i][0], coords[i][1],
+                                                  coords[i][2],
+                                                  sdf_form[4+i][30:])
+    sdf_string = '\n'.join(sdf_form)
+    return sdf_string